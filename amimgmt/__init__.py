@@ -0,0 +1,5 @@
+"""Code shared by the aap-awscf-amimgmt actions.
+
+Every action is built from its own directory, so this package is copied into
+each of them by vendor.sh.  Edit it here, never in an action's copy.
+"""
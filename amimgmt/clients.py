@@ -0,0 +1,130 @@
+import threading
+import time
+from collections.abc import Mapping
+
+import boto3
+import botocore.config
+import botocore.session
+
+from amimgmt.inputs import env_set
+from amimgmt.limits import RateLimiter
+
+
+def newSession(access_key_id="", secret_access_key="", region="us-east-2", profile=None, credentials_file=None):
+    # Build a session from action inputs without touching os.environ.  Empty
+    # keys fall through to boto3's normal credential chain.
+    botocore_session = botocore.session.Session()
+    if credentials_file is not None:
+        botocore_session.set_config_variable("credentials_file", credentials_file)
+    return boto3.Session(
+        aws_access_key_id=access_key_id or None,
+        aws_secret_access_key=secret_access_key or None,
+        region_name=region,
+        profile_name=profile,
+        botocore_session=botocore_session,
+    )
+
+
+class ClientPool:
+    """One boto3 client per (service, region), all built from one shared Session.
+
+    Creating clients from a Session isn't thread-safe, so that part is done
+    under a lock; the clients themselves can be shared between threads.  Each
+    client keeps its own pool of keep-alive connections, so asking for the same
+    (service, region) again reuses the TLS connections already open.  Nothing is
+    built until it's first asked for, and the service model each client needs
+    is loaded once per session, so regions without work cost nothing.
+
+    Throttling errors are retried with jittered backoff; the default adaptive
+    mode also slows a client down once it starts being throttled.  A
+    RateLimiter, if given, paces every request each client sends, and a
+    Metrics, if given, times every call.
+    """
+
+    def __init__(self, session=None, max_pool_connections=25, max_attempts=10, retry_mode="adaptive", limiter=None, metrics=None):
+        if session is None:
+            session = newSession()
+        self.session = session
+        self.limiter = limiter
+        self.metrics = metrics
+        self.config = botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            tcp_keepalive=True,
+            retries={"mode": retry_mode, "max_attempts": max_attempts},
+        )
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, service, region=None):
+        if region is None:
+            region = self.session.region_name
+        key = (service, region)
+        with self._lock:
+            if key not in self._clients:
+                started = time.monotonic()
+                self._clients[key] = self.session.client(service, region_name=region, config=self.config)
+                if self.metrics is not None:
+                    self.metrics.clientCreated(service, region, time.monotonic() - started)
+                if self.limiter is not None:
+                    self.limiter.watch(self._clients[key])
+                if self.metrics is not None:
+                    self.metrics.watch(self._clients[key])
+            return self._clients[key]
+
+
+class LazyClients(Mapping):
+    """region -> client for one service, each created the first time it's looked up."""
+
+    def __init__(self, client_pool, service, regions, inventory=None):
+        self.client_pool = client_pool
+        self.service = service
+        self.regions = list(regions)
+        self.inventory = inventory
+        self._clients = {}
+
+    def __getitem__(self, region):
+        if region not in self.regions:
+            raise KeyError(region)
+        if region not in self._clients:
+            client = self.client_pool.client(self.service, region)
+            if self.inventory is not None:
+                self.inventory.watch(client)
+            self._clients[region] = client
+        return self._clients[region]
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self):
+        return len(self.regions)
+
+
+def newClientPool(session, metrics=None):
+    # Retry and rate-limit settings come from the same inputs in every action;
+    # each pool gets its own limiter since each pool is one account
+    api_rate = float(env_set("INPUT_API_RATE", "20"))
+    limiter = None
+    if api_rate > 0:
+        limiter = RateLimiter(api_rate, float(env_set("INPUT_API_BURST", "40")))
+    return ClientPool(
+        session,
+        max_attempts=int(env_set("INPUT_MAX_ATTEMPTS", "10")),
+        retry_mode=env_set("INPUT_RETRY_MODE", "adaptive"),
+        limiter=limiter,
+        metrics=metrics,
+    )
+
+
+def whoami(client_pool):
+    client = client_pool.client("sts")
+    response = client.get_caller_identity()["Account"]
+    return response
+
+
+def loginEC2Clients(client_pool, regions, inventory=None):
+    return LazyClients(client_pool, "ec2", regions, inventory)
+
+
+def loginS3Client(client_pool, region=None):
+    client = client_pool.client("s3", region)
+    return client
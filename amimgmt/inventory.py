@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+import time
+
+from amimgmt.ec2 import describeImages
+
+# Which cached kinds each mutating EC2 call makes stale in its region
+INVALIDATED_BY = {
+    "CopyImage": ["images", "snapshots"],
+    "CopySnapshot": ["snapshots"],
+    "CreateImage": ["images", "snapshots"],
+    "CreateSnapshot": ["snapshots"],
+    "CreateTags": ["images", "snapshots"],
+    "DeleteSnapshot": ["snapshots"],
+    "DeleteTags": ["images", "snapshots"],
+    "DeregisterImage": ["images"],
+    "RegisterImage": ["images"],
+}
+
+
+class Inventory:
+    """Opt-in, file-backed cache of an account's images and snapshots per region.
+
+    Each entry lives in <cache_dir>/<account>/<region>.<kind>.json as
+    {"fetched": <epoch seconds>, "items": {<id>: <description>}}, so later
+    workflow steps and dashboards can read it without calling EC2.  Entries
+    older than ttl seconds are fetched again.  Clients handed to watch() drop
+    a region's entries whenever they delete, copy or tag something there.
+    """
+
+    def __init__(self, cache_dir, account_id, ttl=900):
+        self.directory = os.path.join(cache_dir, account_id)
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def filename(self, region, kind):
+        return os.path.join(self.directory, "{}.{}.json".format(region, kind))
+
+    def keyLock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def watch(self, client):
+        client.meta.events.register("after-call.ec2", self.afterCall, unique_id="amimgmt-inventory")
+        return client
+
+    def afterCall(self, http_response, model, context, **kwargs):
+        # Failed calls, dry runs included, haven't changed anything
+        if model.name in INVALIDATED_BY and http_response.status_code < 300:
+            self.invalidate(context["client_region"], INVALIDATED_BY[model.name])
+
+    def invalidate(self, region, kinds=("images", "snapshots")):
+        for kind in kinds:
+            with self.keyLock((region, kind)):
+                self._entries.pop((region, kind), None)
+                try:
+                    os.remove(self.filename(region, kind))
+                except FileNotFoundError:
+                    pass
+
+    def load(self, region, kind):
+        entry = self._entries.get((region, kind))
+        if entry is None:
+            try:
+                with open(self.filename(region, kind), "r") as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                return None
+        if time.time() - entry["fetched"] > self.ttl:
+            return None
+        self._entries[(region, kind)] = entry
+        return entry["items"]
+
+    def save(self, region, kind, items):
+        entry = {"fetched": time.time(), "items": items}
+        self._entries[(region, kind)] = entry
+        filename = self.filename(region, kind)
+        tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+        os.makedirs(self.directory, exist_ok=True)
+        with open(tmp_filename, "w") as entry_file:
+            json.dump(entry, entry_file, default=str)
+        os.replace(tmp_filename, filename)
+
+    def fetch(self, client, region, kind):
+        with self.keyLock((region, kind)):
+            items = self.load(region, kind)
+            if items is None:
+                items = {}
+                if kind == "images":
+                    for page in client.get_paginator("describe_images").paginate(Owners=["self"]):
+                        for image in page["Images"]:
+                            items.update({image["ImageId"]: image})
+                else:
+                    for page in client.get_paginator("describe_snapshots").paginate(OwnerIds=["self"]):
+                        for snapshot in page["Snapshots"]:
+                            items.update({snapshot["SnapshotId"]: snapshot})
+                self.save(region, kind, items)
+            return items
+
+    def images(self, client, region):
+        return self.fetch(client, region, "images")
+
+    def snapshots(self, client, region):
+        return self.fetch(client, region, "snapshots")
+
+    def findImages(self, client, region, ami_ids):
+        images = self.images(client, region)
+        image_records = {ami_id: images[ami_id] for ami_id in ami_ids if ami_id in images}
+        # An AMI missing from the entry may just be newer than it, so ask EC2
+        # about those few before treating them as gone
+        image_records.update(describeImages(client, [ami_id for ami_id in ami_ids if ami_id not in images]))
+        return image_records
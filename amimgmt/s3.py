@@ -0,0 +1,16 @@
+def splitS3URI(s3_file):
+    # Break up an S3 URI into usable bits i.e.
+    # s3://positronic-asimov-us-west-2/cdk/template-development-2022-07-12-10-44-52.json
+    # --> positronic-asimov-us-west-2 --> cdk/template-development-2022-07-12-10-44-52.json
+    parts = s3_file.split("s3://")
+    bucket = parts[1].split("/")[0]
+    start = len(bucket) + s3_file.find(bucket) + 1
+    key = s3_file[start:]
+    return bucket, key
+
+
+def bucketRegion(bucket):
+    # Our buckets end in the region they live in, e.g. positronic-asimov-us-west-2
+    bucket_array = bucket.split("-")
+    num_bucket_bits = len(bucket_array)
+    return "{}-{}-{}".format(bucket_array[num_bucket_bits - 3], bucket_array[num_bucket_bits - 2], bucket_array[num_bucket_bits - 1])
@@ -0,0 +1,323 @@
+"""Benchmark the AWS actions against a simulated multi-region backend.
+
+Each action's main() runs in its own child process against moto, with a fleet
+of regions x AMIs x snapshots x S3 keys built up front.  Every HTTP attempt
+the action makes is delayed by --latency-ms and, with --throttle-rate, turned
+into a throttling error once a (service, region) goes over that many requests
+per second, so retry and rate-limiting behaviour shows up in the numbers.
+
+Wall time, API attempts, throttled attempts and peak Python memory are
+compared with benchmarks/baseline.json; the run fails when any of them
+regresses past the tolerance.  --update-baseline records the current numbers
+instead.
+"""
+
+import argparse
+import base64
+import datetime
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+ACTIONS = ["reapsnapshot", "reapamibyname", "promotesnapshot", "promotetoprod"]
+REGIONS = [
+    "us-east-1",
+    "us-east-2",
+    "us-west-1",
+    "us-west-2",
+    "eu-west-1",
+    "eu-west-2",
+    "eu-central-1",
+    "ap-southeast-1",
+    "ap-southeast-2",
+    "ap-northeast-1",
+    "ca-central-1",
+    "sa-east-1",
+]
+PROD_BUCKET = "bench-prod-assets"
+THROTTLE_ERRORS = {
+    "ec2": (503, "<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message></Error></Errors></Response>"),
+    "s3": (503, "<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>"),
+    "sts": (400, "<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error></ErrorResponse>"),
+}
+
+
+class SimulatedBackend:
+    """Stands in front of moto's before-send stubber, adding latency and throttling."""
+
+    def __init__(self, stubber, latency, throttle_rate):
+        self.stubber = stubber
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self.throttled = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def serviceRegion(self, url):
+        host = url.split("/")[2]
+        match = re.search(r"(?:^|\.)(ec2|s3|sts)[.-]?([a-z]{2}-[a-z]+-\d)?", host)
+        if match is None:
+            return "other", None
+        return match.group(1), match.group(2) or "us-east-1"
+
+    def throttle(self, key):
+        # A token bucket per (service, region), refilling at throttle_rate
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            if self.throttle_rate <= 0:
+                return False
+            tokens, updated = self._buckets.get(key, (self.throttle_rate, now))
+            tokens = min(self.throttle_rate, tokens + (now - updated) * self.throttle_rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.throttled += 1
+                return True
+            self._buckets[key] = (tokens - 1, now)
+            return False
+
+    def __call__(self, event_name, request, **kwargs):
+        from botocore.awsrequest import AWSResponse
+        from moto.core.botocore_stubber import MockRawResponse
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+        service, region = self.serviceRegion(request.url)
+        if self.throttle((service, region)) and service in THROTTLE_ERRORS:
+            status, body = THROTTLE_ERRORS[service]
+            return AWSResponse(request.url, status, {}, MockRawResponse(body))
+        return self.stubber(event_name, request, **kwargs)
+
+
+def snapshotDate(index):
+    return (datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=index)).strftime("%Y-%m-%d-%H-%M-%S")
+
+
+def createBucket(s3_client, bucket, region):
+    if region == "us-east-1":
+        s3_client.create_bucket(Bucket=bucket)
+    else:
+        s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": region})
+
+
+def buildFleet(workdir, config):
+    import boto3
+
+    regions = REGIONS[: config["regions"]]
+    ec2_clients = {region: boto3.client("ec2", region_name=region) for region in regions}
+    s3_clients = {region: boto3.client("s3", region_name=region) for region in regions}
+    for region in regions:
+        createBucket(s3_clients[region], "positronic-asimov-{}".format(region), region)
+    createBucket(s3_clients[regions[0]], PROD_BUCKET, regions[0])
+    snapshots_root = os.path.join(workdir, "snapshots")
+    for index in range(config["amis"]):
+        date = snapshotDate(index)
+        snapshot_path = os.path.join(snapshots_root, "SNAPSHOT-{}".format(date))
+        os.makedirs(snapshot_path)
+        ami_map = {}
+        s3_files = []
+        for region in regions:
+            mappings = []
+            for device in range(config["snapshots"]):
+                volume = ec2_clients[region].create_volume(AvailabilityZone="{}a".format(region), Size=8)
+                snap = ec2_clients[region].create_snapshot(VolumeId=volume["VolumeId"])
+                mappings.append({"DeviceName": "/dev/sd{}".format("abcdefghijklmnop"[device]), "Ebs": {"SnapshotId": snap["SnapshotId"]}})
+            image = ec2_clients[region].register_image(Name="bench-{}".format(date), RootDeviceName="/dev/sda", BlockDeviceMappings=mappings)
+            ami_map.update({region: image["ImageId"]})
+            bucket = "positronic-asimov-{}".format(region)
+            for key_index in range(config["s3_keys"]):
+                key = "functions/bench{}-{}.zip".format(key_index, date)
+                s3_clients[region].put_object(Bucket=bucket, Key=key, Body=b"x" * config["s3_bytes"])
+                s3_files.append("s3://{}/{}".format(bucket, key))
+        with open(os.path.join(snapshot_path, "aws-ami-regions_SNAPSHOT-{}.json".format(date)), "w") as out_file:
+            json.dump(ami_map, out_file)
+        with open(os.path.join(snapshot_path, "s3_file_locations.txt"), "w") as out_file:
+            out_file.write("\n".join(s3_files) + "\n")
+        with open(os.path.join(snapshot_path, "resources-{}.json".format(date)), "w") as out_file:
+            json.dump({"s3_files": s3_files}, out_file)
+    return regions, snapshots_root
+
+
+def actionInputs(action, config, workdir, regions, snapshots_root):
+    first = os.path.join(snapshots_root, "SNAPSHOT-{}".format(snapshotDate(0)))
+    inputs = {"INPUT_AWS_REGION": regions[0]}
+    if action == "reapsnapshot":
+        # Sweep every snapshot, so the fleet size is what gets reaped
+        inputs.update({"INPUT_SNAPSHOTS_ROOT": snapshots_root, "INPUT_RETENTION_KEEP": "0"})
+    elif action == "reapamibyname":
+        inputs.update({"INPUT_AMI_NAME": "bench-*", "INPUT_AWS_REGIONS": " ".join(regions)})
+    elif action == "promotesnapshot":
+        inputs.update({"INPUT_SNAPSHOT_PATH": first, "INPUT_SNAPSHOT_DATE": snapshotDate(0)})
+    elif action == "promotetoprod":
+        credentials = "[dev]\naws_access_key_id = bench\naws_secret_access_key = bench\n[prod]\naws_access_key_id = bench\naws_secret_access_key = bench\n"
+        inputs.update(
+            {
+                "INPUT_SNAPSHOT_PATH": first,
+                "INPUT_SNAPSHOT_DATE": snapshotDate(0),
+                "INPUT_AWS_DEV_ENDPOINT_REGION": regions[0],
+                "INPUT_AWS_PROD_ENDPOINT_REGION": regions[0],
+                "INPUT_AWS_PROD_S3_BUCKET": PROD_BUCKET,
+                "INPUT_AWS_SHARED_CREDS_BASE64": base64.b64encode(credentials.encode("utf-8")).decode("utf-8"),
+            }
+        )
+    inputs.update({"INPUT_{}".format(name.upper()): value for name, value in config["inputs"].items()})
+    return inputs
+
+
+def runChild(action, config, result_filename):
+    import botocore.handlers
+    from moto import mock_aws
+
+    workdir = tempfile.mkdtemp(prefix="bench-{}-".format(action))
+    os.chdir(workdir)
+    for name in ["GITHUB_STEP_SUMMARY", "GITHUB_OUTPUT"]:
+        os.environ.pop(name, None)
+    os.environ.update({"AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_DEFAULT_REGION": "us-east-1"})
+    with mock_aws():
+        regions, snapshots_root = buildFleet(workdir, config)
+        os.environ.update(actionInputs(action, config, workdir, regions, snapshots_root))
+        # Sessions the action creates from here on get the simulated backend
+        # instead of moto's stubber; the fleet above was built without it
+        for position, entry in enumerate(botocore.handlers.BUILTIN_HANDLERS):
+            if entry[0] == "before-send" and type(entry[1]).__name__ == "BotocoreStubber":
+                backend = SimulatedBackend(entry[1], config["latency_ms"] / 1000.0, config["throttle_rate"])
+                botocore.handlers.BUILTIN_HANDLERS[position] = (entry[0], backend) + tuple(entry[2:])
+        sys.path.insert(0, os.path.join(ROOT, action))
+        spec = importlib.util.spec_from_file_location("{}_main".format(action), os.path.join(ROOT, action, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        console = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        exit_code = 0
+        tracemalloc.start()
+        started = time.monotonic()
+        try:
+            module.main()
+        except SystemExit as err:
+            exit_code = int(bool(err.code))
+        wall_seconds = time.monotonic() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        sys.stdout = console
+    with open(result_filename, "w") as out_file:
+        json.dump(
+            {
+                "wall_seconds": round(wall_seconds, 3),
+                "api_calls": backend.calls,
+                "throttled": backend.throttled,
+                "peak_kib": peak // 1024,
+                "exit_code": exit_code,
+            },
+            out_file,
+        )
+
+
+def runAction(action, config):
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", action, json.dumps(config), result_file.name])
+        if process.returncode != 0:
+            return {"wall_seconds": 0, "api_calls": 0, "throttled": 0, "peak_kib": 0, "exit_code": process.returncode}
+        with open(result_file.name, "r") as in_file:
+            return json.load(in_file)
+
+
+def scenarioKey(config):
+    fields = ["regions={regions}", "amis={amis}", "snapshots={snapshots}", "s3_keys={s3_keys}", "s3_bytes={s3_bytes}"]
+    fields.extend(["latency_ms={latency_ms:g}", "throttle_rate={throttle_rate:g}"])
+    key = ",".join(fields).format(**config)
+    for name in sorted(config["inputs"]):
+        key += ",{}={}".format(name, config["inputs"][name])
+    return key
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for action in results:
+        result = results[action]
+        if result["exit_code"] != 0:
+            regressions.append("{}: exited with {}".format(action, result["exit_code"]))
+        if action not in baseline:
+            continue
+        for metric in ["wall_seconds", "api_calls", "throttled", "peak_kib"]:
+            # A little slack on top of the tolerance so tiny numbers don't flap
+            limit = baseline[action][metric] * (1 + tolerance) + (0.5 if metric == "wall_seconds" else 1)
+            if result[metric] > limit:
+                regressions.append("{}: {} {} is over the baseline {} (+{:.0%})".format(action, metric, result[metric], baseline[action][metric], tolerance))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("actions", nargs="*", default=ACTIONS, help="Actions to run (default: all AWS actions)")
+    parser.add_argument("--regions", type=int, default=4, help="Regions in the fleet, at most {}".format(len(REGIONS)))
+    parser.add_argument("--amis", type=int, default=10, help="AMIs (and SNAPSHOT directories) per region")
+    parser.add_argument("--snapshots", type=int, default=1, help="EBS snapshots per AMI")
+    parser.add_argument("--s3-keys", type=int, default=5, help="S3 keys per region per snapshot")
+    parser.add_argument("--s3-bytes", type=int, default=1024, help="Size of each S3 object")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Latency added to every HTTP attempt")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="Requests per second per service and region before throttling (0: never)")
+    parser.add_argument("--input", action="append", default=[], metavar="NAME=VALUE", help="Action input to set, e.g. max_workers=16")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed regression as a fraction of the baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="Record these results as the baseline")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        runChild(args.child[0], json.loads(args.child[1]), args.child[2])
+        return 0
+
+    config = {
+        "regions": min(args.regions, len(REGIONS)),
+        "amis": args.amis,
+        "snapshots": args.snapshots,
+        "s3_keys": args.s3_keys,
+        "s3_bytes": args.s3_bytes,
+        "latency_ms": float(args.latency_ms),
+        "throttle_rate": float(args.throttle_rate),
+        "inputs": dict(item.split("=", 1) for item in args.input),
+    }
+    key = scenarioKey(config)
+    print("Scenario: {}".format(key))
+    print("{:<16} {:>10} {:>10} {:>10} {:>10} {:>5}".format("action", "wall s", "api calls", "throttled", "peak KiB", "exit"))
+    results = {}
+    for action in args.actions:
+        results[action] = runAction(action, config)
+        result = results[action]
+        print(
+            "{:<16} {:>10} {:>10} {:>10} {:>10} {:>5}".format(
+                action, result["wall_seconds"], result["api_calls"], result["throttled"], result["peak_kib"], result["exit_code"]
+            )
+        )
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as in_file:
+            baselines = json.load(in_file)
+    if args.update_baseline:
+        baselines.setdefault(key, {}).update(results)
+        with open(args.baseline, "w") as out_file:
+            json.dump(baselines, out_file, indent=4, sort_keys=True)
+            out_file.write("\n")
+        print("Baseline updated in {}".format(args.baseline))
+        return 0
+    if key not in baselines:
+        print("No baseline for this scenario; run with --update-baseline to record one")
+    regressions = compare(results, baselines.get(key, {}), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# Tag promotesnapshot sets on AMIs and snapshots as they move through the
+# pipeline; "deployed" ones are never reaped by retention
+PROMOTION_TAG = "aap-awscf-promotion"
+
+
+def findTagged(client, resource_ids, value):
+    # Which of resource_ids carry PROMOTION_TAG=value, in one filtered
+    # describe_tags per 200 IDs
+    tagged = set()
+    paginator = client.get_paginator("describe_tags")
+    for start in range(0, len(resource_ids), 200):
+        filters = [
+            {"Name": "resource-id", "Values": resource_ids[start : start + 200]},
+            {"Name": "key", "Values": [PROMOTION_TAG]},
+            {"Name": "value", "Values": [value]},
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for tag in page["Tags"]:
+                tagged.add(tag["ResourceId"])
+    return tagged
+
+
+def imageSnapshots(image):
+    # Every EBS volume's snapshot; a blank EBS data volume has no snapshot
+    snaps = []
+    for blockDeviceMap in image.get("BlockDeviceMappings", []):
+        if "SnapshotId" in blockDeviceMap.get("Ebs", {}):
+            snaps.append(blockDeviceMap["Ebs"]["SnapshotId"])
+    return snaps
+
+
+def describeImages(client, ami_ids):
+    # One describe_images call covers every AMI ID in a region.  Filtering on
+    # image-id (rather than passing ImageIds) returns whatever still exists
+    # instead of failing the whole batch on the first missing ID.
+    image_records = {}
+    for start in range(0, len(ami_ids), 200):
+        response = client.describe_images(Filters=[{"Name": "image-id", "Values": ami_ids[start : start + 200]}])
+        for image in response["Images"]:
+            image_records.update({image["ImageId"]: image})
+    return image_records
+
+
+def describeSnapshots(client, snap_ids):
+    # The snapshot equivalent of describeImages, limited to our own snapshots
+    snapshot_records = {}
+    paginator = client.get_paginator("describe_snapshots")
+    for start in range(0, len(snap_ids), 200):
+        for page in paginator.paginate(OwnerIds=["self"], Filters=[{"Name": "snapshot-id", "Values": snap_ids[start : start + 200]}]):
+            for snapshot in page["Snapshots"]:
+                snapshot_records.update({snapshot["SnapshotId"]: snapshot})
+    return snapshot_records
@@ -0,0 +1,19 @@
+import os
+
+
+def env_set(env_var, default):
+    if env_var in os.environ:
+        return os.environ[env_var]
+    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
+        with open(env_var, "r") as env_file:
+            var = env_file.read().strip()
+            env_file.close()
+        return var
+    else:
+        return default
+
+
+def envFlag(env_var, default):
+    # Anything but "false"/"False" counts as true, as the action inputs always have
+    value = env_set(env_var, default)
+    return not (value == "false" or value == "False")
@@ -1,125 +1,119 @@
 import os
-import json
-from io import StringIO
-import sys
-import base64
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from amimgmt.inputs import env_set
+from amimgmt.log import logEvent, startLog, stopLog
+from amimgmt.snapshot import loadSnapshotIndex
 
+log_lock = threading.Lock()
 
-def env_set(env_var, default):
-    if env_var in os.environ:
-        return os.environ[env_var]
-    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
-        with open(env_var, "r") as env_file:
-            var = env_file.read().strip()
-            env_file.close()
-        return var
-    else:
-        return default
-
-
-def copyAssets(snapshot_path, snapshot_date, prod_store_path):
-    return_code = False
-    resource_map = {}
-    image_name = ""
-    for dirname in next(os.walk(snapshot_path))[1]:
-        object_storage = ""
-        account_copied_to = ""
-        account_destined_for = ""
-        try:
-            full_path="{}/{}/gcp-machine-image-manifest.json".format(snapshot_path,dirname)
-            with open(full_path, "r") as a_file:
-                resource_text = a_file.read()
-                resource_map = json.loads(resource_text)
-                image_name = resource_map["builds"][0]["artifact_id"]
-            # print("full_path: {}".format(full_path))
-        except:
-            try:
-                full_path="{}/{}/gcp-machine-image-manifest_{}.json".format(snapshot_path,dirname,snapshot_date)
-                with open(full_path, "r") as a_file:
-                    resource_text = a_file.read()
-                    resource_map = json.loads(resource_text)
-                    image_name = resource_map["builds"][0]["artifact_id"]
-                # print("full_path: {}".format(full_path))
-            except:
-                print("Didn't find the image created in {}/{}!".format(snapshot_path,dirname))
-        try:
-            full_path="{}/{}/gcp_project_id.txt".format(snapshot_path,dirname)
-            with open(full_path, "r") as a_file:
-                account_copied_to = a_file.read().strip()
-            # print("    sub-build {} account copied to: {}".format(dirname,account_copied_to))
-        except:
-            account_copied_to = 'gc-ansible-cloud'
-            print("Didn't find the gcp project stuff for sub-build {}, assuming '{}'".format(dirname,account_copied_to))
-        try:
-            full_path="{}/{}/destination_project_id.txt".format(snapshot_path,dirname)
-            with open(full_path, "r") as a_file:
-                account_destined_for = a_file.read().strip()
-            # print("account destined for: {}".format(account_destined_for))
-        except:
-            print("Didn't find the destination gcp project ID for sub-build {}, assuming {}".format(dirname,account_copied_to))
-            account_destined_for = account_copied_to
-        try:
-            full_path="{}/{}/object-storage.out".format(snapshot_path,dirname)
-            with open(full_path, "r") as a_file:
-                object_storage = a_file.read().strip()
-            # print("account destined for: {}".format(account_destined_for))
-        except:
-            print("No object storage exists for sub-build {}.".format(dirname));
-        if (account_destined_for != account_copied_to) & (image_name != ""):
-            print("Copying sub-build {} image {} to {} since account_destined_for is {} and account_copied_to is {}.".format(dirname,image_name, account_destined_for,account_copied_to,account_destined_for))
-            print("gcloud compute --project={} images create {} --source-image={} --source-image-project={}".format(account_destined_for, image_name, image_name, account_copied_to))
-            process = subprocess.run(["gcloud", 
-                "compute", 
-                "--project={}".format(account_destined_for), 
-                "images", 
-                "create", 
-                "{}".format(image_name), 
-                "--source-image={}".format(image_name), 
-                "--source-image-project={}".format(account_copied_to)],
-                capture_output=True, 
-                text=True)
-            if (process.stdout != ''): print(process.stdout)
-            if (process.stderr != ''): print(process.stderr)
-        if (account_destined_for != account_copied_to) & (object_storage != ""):
-            print("Copying sub-build {} zip   {} to {}".format(dirname,object_storage, account_destined_for))
-            head, tail = os.path.split(object_storage)
-            print("gsutil cp {} gs://{}/{}".format(object_storage, prod_store_path, tail))
-            process = subprocess.run(["gsutil", "cp", "{}".format(object_storage), "gs://{}/{}".format(prod_store_path, tail)], capture_output=True, text=True)
-            if (process.stdout != ''): print(process.stdout)
-            if (process.stderr != ''): print(process.stderr)
-
-
-        return_code = True
-    return return_code
+
+def logLine(dirname, text):
+    # Sub-builds run concurrently, so write each prefixed line in one go
+    with log_lock:
+        for line in text.splitlines():
+            print("[{}] {}".format(dirname, line))
+
+
+def runLogged(dirname, args, resource, operation):
+    logLine(dirname, " ".join(args))
+    started = time.monotonic()
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as err:
+        logLine(dirname, "Couldn't run {}: {}".format(args[0], err))
+        logEvent(resource, None, operation, "failed", started, sub_build=dirname, error=str(err))
+        return False
+    for line in process.stdout:
+        logLine(dirname, line.rstrip("\n"))
+    returncode = process.wait()
+    if returncode != 0:
+        logLine(dirname, "{} exited with {}".format(args[0], returncode))
+    logEvent(resource, None, operation, "copied" if returncode == 0 else "failed", started, sub_build=dirname, returncode=returncode)
+    return returncode == 0
+
+
+def copySubBuild(sub_build, prod_store_path):
+    success = True
+    dirname = sub_build.name
+    image_name = sub_build.image_name
+    object_storage = sub_build.object_storage
+    account_copied_to = sub_build.project_id
+    account_destined_for = sub_build.destination_project_id
+    if image_name == "":
+        logLine(dirname, "Didn't find the image created in {}!".format(dirname))
+    if account_copied_to == "":
+        account_copied_to = "gc-ansible-cloud"
+        logLine(dirname, "Didn't find the gcp project stuff for sub-build {}, assuming '{}'".format(dirname, account_copied_to))
+    if account_destined_for == "":
+        logLine(dirname, "Didn't find the destination gcp project ID for sub-build {}, assuming {}".format(dirname, account_copied_to))
+        account_destined_for = account_copied_to
+    if object_storage == "":
+        logLine(dirname, "No object storage exists for sub-build {}.".format(dirname))
+    if (account_destined_for != account_copied_to) & (image_name != ""):
+        logLine(
+            dirname,
+            "Copying sub-build {} image {} to {} since account_destined_for is {} and account_copied_to is {}.".format(
+                dirname, image_name, account_destined_for, account_destined_for, account_copied_to
+            ),
+        )
+        success = runLogged(
+            dirname,
+            [
+                "gcloud",
+                "compute",
+                "--project={}".format(account_destined_for),
+                "images",
+                "create",
+                "{}".format(image_name),
+                "--source-image={}".format(image_name),
+                "--source-image-project={}".format(account_copied_to),
+            ],
+            image_name,
+            "images_create",
+        )
+    if (account_destined_for != account_copied_to) & (object_storage != ""):
+        logLine(dirname, "Copying sub-build {} zip   {} to {}".format(dirname, object_storage, account_destined_for))
+        head, tail = os.path.split(object_storage)
+        if not runLogged(dirname, ["gsutil", "cp", "{}".format(object_storage), "gs://{}/{}".format(prod_store_path, tail)], object_storage, "gsutil_cp"):
+            success = False
+    return success
+
+
+def copyAssets(index, prod_store_path, max_workers):
+    # Image creation takes minutes, so copy sub-builds side by side and let the
+    # slowest one set the pace
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda sub_build: copySubBuild(sub_build, prod_store_path), index.sub_builds))
+    for sub_build, result in zip(index.sub_builds, results):
+        print("Sub-build {}: {}".format(sub_build.name, "ok" if result else "FAILED"))
+    return len(results) > 0 and all(results)
 
 
 def main():
 
-    # Reorient stdout to a string so we can capture it
-    tmp_stdout = sys.stdout
-    string_stdout = StringIO()
-    sys.stdout = string_stdout
+    # Stream stdout to the console and the log file as it's printed
+    startLog(env_set("INPUT_LOG_FILENAME", "promotegcptoprod.log"), env_set("INPUT_EVENTS_FILENAME", ""), "a")
 
     # Prime the stdout pump - we seem to lose the first line otherwise
     print()
 
     snapshot_path = env_set("INPUT_SNAPSHOT_PATH", "")
     snapshot_date = env_set("INPUT_SNAPSHOT_DATE", "")
-    log_filename = env_set("INPUT_LOG_FILENAME", "promotegcptoprod.log")
     prod_store_path = env_set("INPUT_GCP_PROD_STORAGE_PATH", "aap-aoc-code-assets")
     gcloud_path = env_set("GCLOUD_PATH", "/opt/hostedtoolcache/gcloud/411.0.0/x64/bin/gcloud")
+    max_workers = max(1, int(env_set("INPUT_MAX_WORKERS", "4")))
 
     process = subprocess.run(["{}".format(gcloud_path), "auth", "list"], capture_output=True, text=True)
-    if (process.stdout != ''): print(process.stdout)
-    if (process.stderr != ''): print(process.stderr)
-    success = copyAssets(snapshot_path, snapshot_date, prod_store_path)
-
-    # Reorient stdout back to normal, dump out what it was, and return value to action
-    sys.stdout = tmp_stdout
-    with open(log_filename, "a") as out_file:
-        out_file.write(string_stdout.getvalue())
-        out_file.close()
+    if process.stdout != "":
+        print(process.stdout)
+    if process.stderr != "":
+        print(process.stderr)
+    success = copyAssets(loadSnapshotIndex(snapshot_path, snapshot_date), prod_store_path, max_workers)
+
+    stopLog()
     exit(not success)
 
 
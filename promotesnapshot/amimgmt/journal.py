@@ -0,0 +1,63 @@
+import datetime
+import json
+import os
+import threading
+
+
+class Journal:
+    """Append-only JSON-lines record of finished reaping actions.
+
+    Each line is written and flushed as soon as an action completes, so a run
+    that dies halfway leaves behind exactly what it got done.  Loading the
+    same file on a re-run lets the caller skip those actions and carry on with
+    the rest.  Records are keyed by (resource, operation); AMI, snapshot and
+    S3 URIs are unique enough on their own.  A read-only journal, for dry
+    runs and plans, loads whatever is there but never creates the file.
+    """
+
+    def __init__(self, filename, read_only=False):
+        self.filename = filename
+        self.done = {}
+        self._lock = threading.Lock()
+        complete = True
+        if os.path.exists(filename):
+            with open(filename, "r") as in_file:
+                for line in in_file:
+                    complete = line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short when the last run died
+                        continue
+                    self.done.update({(record["resource"], record["operation"]): record})
+        self.out_file = None
+        if not read_only:
+            self.out_file = open(filename, "a")
+            if not complete:
+                self.out_file.write("\n")
+        if len(self.done) > 0:
+            print("Resuming from {}: {} actions already done".format(filename, len(self.done)))
+
+    def finished(self, resource, operation):
+        return self.done.get((resource, operation))
+
+    def record(self, resource, region, operation, outcome, **fields):
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "resource": resource,
+            "region": region,
+            "operation": operation,
+            "outcome": outcome,
+        }
+        record.update(fields)
+        line = json.dumps(record, default=str, sort_keys=True)
+        with self._lock:
+            self.done.update({(resource, operation): record})
+            if self.out_file is not None:
+                self.out_file.write(line + "\n")
+                self.out_file.flush()
+                os.fsync(self.out_file.fileno())
+
+    def close(self):
+        if self.out_file is not None:
+            self.out_file.close()
@@ -0,0 +1,102 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+current = None
+
+
+class LineStream:
+    """Stand-in for sys.stdout that copies each finished line to the console
+    and the log file as soon as it's printed.
+
+    Text is held per thread until its newline arrives, so lines printed by
+    concurrent workers come out whole instead of interleaved mid-line.
+    """
+
+    def __init__(self, console, log_file):
+        self.console = console
+        self.log_file = log_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        pending = getattr(self._local, "pending", "") + text
+        lines, newline, rest = pending.rpartition("\n")
+        self._local.pending = rest
+        if newline:
+            self.emit(lines + newline)
+        return len(text)
+
+    def emit(self, text):
+        with self._lock:
+            self.console.write(text)
+            self.console.flush()
+            self.log_file.write(text)
+            self.log_file.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pending = getattr(self._local, "pending", "")
+        self._local.pending = ""
+        if pending:
+            self.emit(pending + "\n")
+
+
+class Log:
+    """The streamed transcript plus a JSON-lines file of per-resource events."""
+
+    def __init__(self, log_filename, events_filename="", mode="w"):
+        if events_filename == "":
+            events_filename = "{}.events.jsonl".format(os.path.splitext(log_filename)[0])
+        self.log_file = open(log_filename, mode)
+        self.events_file = open(events_filename, mode)
+        self.console = sys.stdout
+        self.stream = LineStream(self.console, self.log_file)
+        self._lock = threading.Lock()
+
+    def event(self, resource, region, operation, outcome, started=None, **fields):
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "resource": resource,
+            "region": region,
+            "operation": operation,
+            "outcome": outcome,
+            "duration": None if started is None else round(time.monotonic() - started, 3),
+        }
+        record.update(fields)
+        line = json.dumps(record, default=str, sort_keys=True)
+        with self._lock:
+            self.events_file.write(line + "\n")
+            self.events_file.flush()
+
+    def close(self):
+        self.stream.close()
+        self.log_file.close()
+        self.events_file.close()
+
+
+def startLog(log_filename, events_filename="", mode="w"):
+    global current
+    current = Log(log_filename, events_filename, mode)
+    sys.stdout = current.stream
+    return current
+
+
+def stopLog():
+    global current
+    if current is not None:
+        sys.stdout = current.console
+        current.close()
+        current = None
+
+
+def logEvent(resource, region, operation, outcome, started=None, **fields):
+    # Quietly does nothing outside startLog()/stopLog(), so helpers can be
+    # called from scripts and tests without setting a log up
+    if current is not None:
+        current.event(resource, region, operation, outcome, started, **fields)
@@ -1,180 +1,303 @@
 import os
-import boto3
 import botocore.exceptions
 import json
-import glob
-from io import StringIO
-import sys
+import time
+from amimgmt.clients import loginEC2Clients, newClientPool, newSession, whoami
+from amimgmt.ec2 import PROMOTION_TAG, describeImages, findTagged, imageSnapshots
+from amimgmt.inputs import env_set
+from amimgmt.inventory import Inventory
+from amimgmt.log import logEvent, startLog, stopLog
+from amimgmt.metrics import Metrics
+from amimgmt.snapshot import findAMIs, loadSnapshotIndex, saveAMIMap
 
 
-def env_set(env_var, default):
-    if env_var in os.environ:
-        return os.environ[env_var]
-    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
-        with open(env_var, "r") as env_file:
-            var = env_file.read().strip()
-            env_file.close()
-        return var
-    else:
-        return default
-
-
-def whoami():
-    client = boto3.client("sts")
-    response = client.get_caller_identity()["Account"]
-    return response
-
-
-def findAMIs(snapshot_path, snapshot_date):
-    ami_map = {}
-    try:
-        with open("{}/aws-ami-regions_SNAPSHOT-{}.json".format(snapshot_path, snapshot_date), "r") as ami_file:
-            ami_text = ami_file.read()
-            ami_map = json.loads(ami_text)
-    except:
-        print("Didn't find {}/aws-ami-regions_SNAPSHOT-{}.json; checking by name".format(snapshot_path, snapshot_date))
-        filenamesList = glob.glob("{}/aws-ami*.json".format(snapshot_path))
-        try:
-            with open("{}".format(filenamesList[0]), "r") as ami_file:
-                ami_text = ami_file.read()
-                ami_map = json.loads(ami_text)
-            print("...and succeeded")
-        except:
-            print("Didn't find regions when looking at the first file name in {}.".format(json.dumps(filenamesList)))
-    return ami_map
-
-
-def loginEC2Clients(ami_map):
-    client_map = {}
+def findImages(client_map, ami_map, inventory=None):
+    image_map = {}
     for region in ami_map:
-        os.environ["AWS_DEFAULT_REGION"] = region
-        client = boto3.client("ec2")
-        element = {region: client}
-        client_map.update(element)
-    return client_map
-
-
-def loginS3Client(region):
-    os.environ["AWS_DEFAULT_REGION"] = region
-    client = boto3.client("s3")
-    return client
+        try:
+            if inventory is not None:
+                image_map.update({region: inventory.findImages(client_map[region], region, [ami_map[region]])})
+            else:
+                image_map.update({region: describeImages(client_map[region], [ami_map[region]])})
+        except botocore.exceptions.ClientError as err1:
+            print("Try of describe_images in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+    return image_map
 
 
-def findSNAPs(client_map, ami_map):
+def findSNAPs(image_map, ami_map):
     snap_map = {}
     for region in ami_map:
-        client = client_map[region]
-        try:
-            response = client.describe_images(ImageIds=[ami_map[region]])
-            for image in response["Images"]:
-                for blockDeviceMap in image["BlockDeviceMappings"]:
-                    snap = blockDeviceMap["Ebs"]["SnapshotId"]
-                    element = {region: snap}
-                    snap_map.update(element)
-        except:
+        image = image_map.get(region, {}).get(ami_map[region])
+        if image is None:
             print("Nope, AMI {} isn't in this region, so we can't look up its snaps".format(ami_map[region]))
+            continue
+        # Every EBS volume has its own snapshot, and all of them are promoted
+        snaps = imageSnapshots(image)
+        snap_map.update({region: snaps})
     return snap_map
 
 
-def retagAMIs(client_map, ami_map, new_tag):
-    print("retagAMIs entry, retagging to {}".format(new_tag))
-    success = True
-    for region in ami_map:
-        try:
-            print("Looking for {} in region {}:".format(ami_map[region], region))
-            client_map[region].describe_images(ImageIds=[ami_map[region]])
-            try:
-                response = client_map[region].create_tags(
-                    DryRun=False,
-                    Resources=[ami_map[region]],
-                    Tags=[
-                        {"Key": "aap-awscf-promotion", "Value": "deployed"},
-                    ],
-                )
-                if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                    print("Updated, ok")
-                else:
-                    print(json.dumps(response, indent=4))
-            except botocore.exceptions.ClientError as err2:
-                if err2.response["Error"]["Code"] == "DryRunOperation":
-                    print("Dry run, ok")
-                else:
-                    print("Try of create_tag error: {}".format(err2))
-                    success = False
-        except botocore.exceptions.ClientError as err1:
-            if err1.response["Error"]["Code"] == "InvalidAMIID.NotFound":
-                print("AMI no longer present; continuing.")
-            else:
-                print("Try of describe_images error: {}\n{}".format(json.dumps(err1.response, indent=4), err1))
-                success = False
-    print("retagAMIs exit, returning {}".format(success))
-    return success
-
-
-def retagSNAPs(client_map, snap_map, new_tag):
-    print("retagSNAPS entry, retagging to {}".format(new_tag))
+def tagResources(client, resource_ids, new_tag):
     success = True
-    for region in snap_map:
+    region = client.meta.region_name
+    # create_tags accepts up to 1000 resource IDs per request
+    for start in range(0, len(resource_ids), 1000):
+        chunk = resource_ids[start : start + 1000]
+        started = time.monotonic()
         try:
-            print("Looking for {} in region {}:".format(snap_map[region], region))
-            response = client_map[region].create_tags(
+            response = client.create_tags(
                 DryRun=False,
-                Resources=[snap_map[region]],
+                Resources=chunk,
                 Tags=[
-                    {"Key": "aap-awscf-promotion", "Value": "deployed"},
+                    {"Key": PROMOTION_TAG, "Value": new_tag},
                 ],
             )
             if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                print("Updated, ok")
+                print("Updated {}, ok".format(", ".join(chunk)))
+                for resource_id in chunk:
+                    logEvent(resource_id, region, "create_tags", "tagged", started, tag=new_tag)
             else:
                 print(json.dumps(response, indent=4))
         except botocore.exceptions.ClientError as err2:
             if err2.response["Error"]["Code"] == "DryRunOperation":
                 print("Dry run, ok")
-            elif err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
-                print("Seems to be gone, guessing ok")
+            elif err2.response["Error"]["Code"] in ["InvalidAMIID.NotFound", "InvalidSnapshot.NotFound"] and len(chunk) > 1:
+                # One missing resource fails the whole request, so fall back to
+                # tagging this chunk one ID at a time to find out which it was
+                print("Batch hit {}; retagging one at a time".format(err2.response["Error"]["Code"]))
+                for resource_id in chunk:
+                    if not tagResources(client, [resource_id], new_tag):
+                        success = False
+            elif err2.response["Error"]["Code"] in ["InvalidAMIID.NotFound", "InvalidSnapshot.NotFound"]:
+                print("{} seems to be gone, guessing ok".format(chunk[0]))
+                logEvent(chunk[0], region, "create_tags", "gone", started, tag=new_tag)
             else:
                 print("Try of create_tags error: {}\n{}".format(json.dumps(err2.response, indent=4), err2))
+                for resource_id in chunk:
+                    logEvent(resource_id, region, "create_tags", "failed", started, tag=new_tag, error=err2.response["Error"]["Code"])
                 success = False
-    print("retagSNAPs exit, returning {}".format(success))
     return success
 
 
-def main():
+def retagRegions(client_map, ami_map, image_map, snap_map, new_tag):
+    print("retagRegions entry, retagging to {}".format(new_tag))
+    success = True
+    for region in ami_map:
+        print("Looking for {} in region {}:".format(ami_map[region], region))
+        if region not in image_map:
+            print("Couldn't describe images in region {}".format(region))
+            success = False
+            continue
+        resource_ids = []
+        if ami_map[region] in image_map[region]:
+            resource_ids.append(ami_map[region])
+        else:
+            print("AMI no longer present; continuing.")
+        resource_ids.extend(snap_map.get(region, []))
+        if len(resource_ids) == 0:
+            continue
+        try:
+            tagged = findTagged(client_map[region], resource_ids, new_tag)
+        except botocore.exceptions.ClientError as err1:
+            print("Try of describe_tags error: {}\n{}".format(json.dumps(err1.response, indent=4), err1))
+            success = False
+            continue
+        for resource_id in resource_ids:
+            if resource_id in tagged:
+                print("{} already {}, ok".format(resource_id, new_tag))
+                logEvent(resource_id, region, "create_tags", "skipped", tag=new_tag)
+        untagged = [resource_id for resource_id in resource_ids if resource_id not in tagged]
+        if len(untagged) > 0 and not tagResources(client_map[region], untagged, new_tag):
+            success = False
+    print("retagRegions exit, returning {}".format(success))
+    return success
+
 
-    # Reorient stdout to a string so we can capture it
-    tmp_stdout = sys.stdout
-    string_stdout = StringIO()
-    sys.stdout = string_stdout
+def findReplicas(client_map, regions, name):
+    # Copies an earlier, interrupted run already started are picked up
+    # rather than copied again.  A region that can't be looked at isn't
+    # copied to, since a copy there may already be under way.
+    replicas = {}
+    failed = []
+    for region in regions:
+        try:
+            response = client_map[region].describe_images(Owners=["self"], Filters=[{"Name": "name", "Values": [name]}])
+        except botocore.exceptions.ClientError as err1:
+            print("Try of describe_images in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+            logEvent(name, region, "describe_images", "failed", error=err1.response["Error"]["Code"])
+            failed.append(region)
+            continue
+        for image in response["Images"]:
+            if image["State"] in ["available", "pending"]:
+                replicas.update({region: image})
+    return replicas, failed
+
+
+def startCopy(client, region, job, in_flight, slots):
+    started = time.monotonic()
+    try:
+        response = client.copy_image(Name=job["name"], SourceImageId=job["ami_id"], SourceRegion=job["source_region"])
+    except botocore.exceptions.ClientError as err1:
+        if err1.response["Error"]["Code"] == "ResourceLimitExceeded":
+            # Hold the destination at what it's running now and try again later
+            slots.update({region: max(1, len(in_flight.get(region, {})))})
+            print("Copy limit reached in region {}; holding at {} concurrent copies".format(region, slots[region]))
+            return None
+        print("Try of copy_image to region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+        logEvent(job["ami_id"], region, "copy_image", "failed", started, source_region=job["source_region"], error=err1.response["Error"]["Code"])
+        return False
+    print("Copying {} from region {} to region {} as {}".format(job["ami_id"], job["source_region"], region, response["ImageId"]))
+    logEvent(response["ImageId"], region, "copy_image", "started", started, source=job["ami_id"], source_region=job["source_region"])
+    in_flight.setdefault(region, {}).update({response["ImageId"]: (job, started)})
+    return True
+
+
+def replicateAMIs(client_map, jobs, new_tag, max_copies, timeout, first_delay=5, max_delay=60):
+    # jobs are {"ami_id", "name", "source_region", "region"}; no destination
+    # has more than max_copies copies in flight, and every destination's
+    # in-flight copies are polled with one describe_images per round
+    print("replicateAMIs entry, {} copies, at most {} at a time per region".format(len(jobs), max_copies))
+    success = True
+    replicated = {}
+    queued = list(jobs)
+    in_flight = {}
+    slots = {}
+    # Copies describe_images didn't return last round; a brand new copy can
+    # take a moment to show up, but one missing twice is gone
+    unseen = set()
+    deadline = time.monotonic() + timeout
+    delay = first_delay
+    while len(queued) > 0 or any(len(copies) > 0 for copies in in_flight.values()):
+        waiting = []
+        for job in queued:
+            region = job["region"]
+            if "copy_id" in job:
+                in_flight.setdefault(region, {}).update({job["copy_id"]: (job, time.monotonic())})
+            elif len(in_flight.get(region, {})) >= slots.get(region, max_copies):
+                waiting.append(job)
+            else:
+                started = startCopy(client_map[region], region, job, in_flight, slots)
+                if started is None:
+                    waiting.append(job)
+                elif not started:
+                    success = False
+        queued = waiting
+        remaining_time = deadline - time.monotonic()
+        if remaining_time <= 0:
+            break
+        time.sleep(min(delay, remaining_time))
+        delay = min(delay * 2, max_delay)
+        for region in sorted(in_flight):
+            copy_ids = sorted(in_flight[region])
+            if len(copy_ids) == 0:
+                continue
+            try:
+                images = describeImages(client_map[region], copy_ids)
+            except botocore.exceptions.ClientError as err1:
+                print("Try of describe_images in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+                continue
+            for copy_id in copy_ids:
+                if copy_id not in images and copy_id not in unseen:
+                    unseen.add(copy_id)
+                    continue
+                state = images.get(copy_id, {}).get("State", "missing")
+                if state == "pending":
+                    continue
+                job, started = in_flight[region].pop(copy_id)
+                if state == "missing":
+                    print("Copy {} in region {} has disappeared".format(copy_id, region))
+                    logEvent(copy_id, region, "copy_image", "failed", started, source=job["ami_id"], error=state)
+                    success = False
+                elif state == "available":
+                    print("{} available in region {}".format(copy_id, region))
+                    logEvent(copy_id, region, "copy_image", "available", started, source=job["ami_id"])
+                    replicated.update({region: copy_id})
+                    snaps = imageSnapshots(images[copy_id])
+                    if not tagResources(client_map[region], [copy_id] + snaps, new_tag):
+                        success = False
+                else:
+                    print("Copy {} in region {} ended {}: {}".format(copy_id, region, state, images[copy_id].get("StateReason", {}).get("Message", "")))
+                    logEvent(copy_id, region, "copy_image", "failed", started, source=job["ami_id"], error=state)
+                    success = False
+    for job in queued:
+        print("Timed out before {} could be copied to region {}".format(job["ami_id"], job["region"]))
+        success = False
+    for region in sorted(in_flight):
+        for copy_id in sorted(in_flight[region]):
+            print("Timed out waiting for {} in region {}; it's still copying".format(copy_id, region))
+            logEvent(copy_id, region, "copy_image", "timeout", in_flight[region][copy_id][1])
+            success = False
+    print("replicateAMIs exit, returning {}".format(success))
+    return success, replicated
+
+
+def main():
+    # Stream stdout to the console and the log file as it's printed
+    log_filename = env_set("INPUT_LOG_FILENAME", "promotion.log")
+    metrics_filename = env_set("INPUT_METRICS_FILENAME", "") or "{}.metrics.json".format(os.path.splitext(log_filename)[0])
+    metrics = Metrics()
+    startLog(log_filename, env_set("INPUT_EVENTS_FILENAME", ""))
 
     # Prime the stdout pump - we seem to lose the first line otherwise
     print()
 
-    os.environ["AWS_ACCESS_KEY_ID"] = env_set("INPUT_AWS_ACCESS_KEY_ID", "")
-    os.environ["AWS_SECRET_ACCESS_KEY"] = env_set("INPUT_AWS_SECRET_ACCESS_KEY", "")
-    os.environ["AWS_DEFAULT_REGION"] = env_set("INPUT_AWS_REGION", "us-east-2")
+    session = newSession(
+        env_set("INPUT_AWS_ACCESS_KEY_ID", ""),
+        env_set("INPUT_AWS_SECRET_ACCESS_KEY", ""),
+        env_set("INPUT_AWS_REGION", "us-east-2"),
+    )
+    client_pool = newClientPool(session, metrics)
 
     snapshot_path = env_set("INPUT_SNAPSHOT_PATH", "")
     snapshot_date = env_set("INPUT_SNAPSHOT_DATE", "")
-    log_filename = env_set("INPUT_LOG_FILENAME", "promotion.log")
+    inventory_cache = env_set("INPUT_INVENTORY_CACHE", "")
+    inventory_ttl = int(env_set("INPUT_INVENTORY_TTL", "900"))
+    replicate_regions = env_set("INPUT_REPLICATE_REGIONS", "").split()
+    replicate_source_region = env_set("INPUT_REPLICATE_SOURCE_REGION", "") or env_set("INPUT_AWS_REGION", "us-east-2")
+    replicate_max_copies = max(1, int(env_set("INPUT_REPLICATE_MAX_COPIES", "5")))
+    replicate_timeout = int(env_set("INPUT_REPLICATE_TIMEOUT", "3600"))
 
-    aws_account_id = whoami()
-    ami_map = findAMIs(snapshot_path, snapshot_date)
-    ec2_client_map = loginEC2Clients(ami_map)
-    # print("Client map: \n{}".format(json.dumps(ec2_client_map, indent=4)))
-    snap_map = findSNAPs(ec2_client_map, ami_map)
+    aws_account_id = whoami(client_pool)
+    inventory = None
+    if inventory_cache != "":
+        inventory = Inventory(inventory_cache, aws_account_id, inventory_ttl)
+    index = loadSnapshotIndex(snapshot_path, snapshot_date)
+    ami_map = findAMIs(index)
+    ec2_client_map = loginEC2Clients(client_pool, ami_map, inventory)
+    image_map = findImages(ec2_client_map, ami_map, inventory)
+    snap_map = findSNAPs(image_map, ami_map)
     print("AWS account ID:\n{}".format(json.dumps(aws_account_id, indent=4)))
     print("AMI map:\n{}".format(json.dumps(ami_map, indent=4)))
     print("SNAP map:\n{}".format(json.dumps(snap_map, indent=4)))
     success = False
-    success = retagAMIs(ec2_client_map, ami_map, "deployed")
-    if success:
-        success = retagSNAPs(ec2_client_map, snap_map, "deployed")
-    # Reorient stdout back to normal, dump out what it was, and return value to action
-    sys.stdout = tmp_stdout
-    with open(log_filename, "w") as out_file:
-        out_file.write(string_stdout.getvalue())
-        out_file.close()
+    success = retagRegions(ec2_client_map, ami_map, image_map, snap_map, "deployed")
+    targets = [region for region in replicate_regions if region not in ami_map]
+    if success and len(targets) > 0:
+        if replicate_source_region not in ami_map:
+            replicate_source_region = sorted(ami_map)[0] if len(ami_map) > 0 else replicate_source_region
+        source_image = image_map.get(replicate_source_region, {}).get(ami_map.get(replicate_source_region))
+        if source_image is None:
+            print("No AMI to replicate from region {}".format(replicate_source_region))
+            success = False
+        else:
+            target_client_map = loginEC2Clients(client_pool, targets, inventory)
+            replicas, failed = findReplicas(target_client_map, targets, source_image["Name"])
+            if len(failed) > 0:
+                success = False
+            jobs = []
+            for region in [region for region in targets if region not in failed]:
+                job = {"ami_id": source_image["ImageId"], "name": source_image["Name"], "source_region": replicate_source_region, "region": region}
+                if region in replicas:
+                    print("{} already copied to region {} as {}".format(source_image["ImageId"], region, replicas[region]["ImageId"]))
+                    job.update({"copy_id": replicas[region]["ImageId"]})
+                jobs.append(job)
+            replicate_success, replicated = replicateAMIs(target_client_map, jobs, "deployed", replicate_max_copies, replicate_timeout)
+            success = success and replicate_success
+            if len(replicated) > 0:
+                ami_map.update(replicated)
+                print("Wrote region map to {}:\n{}".format(saveAMIMap(index, ami_map), json.dumps(ami_map, indent=4)))
+    metrics.report(metrics_filename, "promotesnapshot")
+    stopLog()
     exit(not success)
 
 
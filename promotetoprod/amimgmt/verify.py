@@ -0,0 +1,132 @@
+import threading
+import time
+
+import botocore.exceptions
+
+from amimgmt.log import logEvent
+
+
+class PendingDeletions:
+    """Every deregistration and snapshot deletion still waiting to be confirmed.
+
+    Snapshots whose delete failed with InvalidSnapshot.InUse are kept apart
+    with the AMI that owns them, and deleted again once that AMI is confirmed
+    gone.  Safe to fill from several region workers at once.
+    """
+
+    def __init__(self):
+        # region -> {resource id: monotonic time it was queued}
+        self.images = {}
+        self.snapshots = {}
+        # region -> {snapshot id: [owning AMI id or None, time queued]}
+        self.in_use = {}
+        self._lock = threading.Lock()
+
+    def image(self, region, ami_id):
+        with self._lock:
+            self.images.setdefault(region, {}).update({ami_id: time.monotonic()})
+
+    def snapshot(self, region, snap_id):
+        with self._lock:
+            self.snapshots.setdefault(region, {}).update({snap_id: time.monotonic()})
+
+    def inUse(self, region, snap_id, ami_id):
+        with self._lock:
+            self.in_use.setdefault(region, {}).update({snap_id: [ami_id, time.monotonic()]})
+
+    def regions(self):
+        return sorted(region for region in set(self.images) | set(self.snapshots) | set(self.in_use) if self.count(region) > 0)
+
+    def count(self, region=None):
+        if region is None:
+            return sum(self.count(region) for region in set(self.images) | set(self.snapshots) | set(self.in_use))
+        return len(self.images.get(region, {})) + len(self.snapshots.get(region, {})) + len(self.in_use.get(region, {}))
+
+
+def remainingImages(client, ami_ids):
+    remaining = set()
+    for start in range(0, len(ami_ids), 200):
+        response = client.describe_images(Filters=[{"Name": "image-id", "Values": ami_ids[start : start + 200]}])
+        for image in response["Images"]:
+            if image.get("State") != "deregistered":
+                remaining.add(image["ImageId"])
+    return remaining
+
+
+def remainingSnapshots(client, snap_ids):
+    remaining = set()
+    paginator = client.get_paginator("describe_snapshots")
+    for start in range(0, len(snap_ids), 200):
+        for page in paginator.paginate(OwnerIds=["self"], Filters=[{"Name": "snapshot-id", "Values": snap_ids[start : start + 200]}]):
+            for snapshot in page["Snapshots"]:
+                remaining.add(snapshot["SnapshotId"])
+    return remaining
+
+
+def retryInUse(client, region, pending, journal=None):
+    for snap_id in sorted(pending.in_use.get(region, {})):
+        ami_id, queued = pending.in_use[region][snap_id]
+        if ami_id is not None and ami_id in pending.images.get(region, {}):
+            continue
+        try:
+            client.delete_snapshot(SnapshotId=snap_id)
+            print("Retried {} in region {} now {} is gone, ok".format(snap_id, region, ami_id))
+            logEvent(snap_id, region, "delete_snapshot", "deleted", queued, retried=True)
+            if journal is not None:
+                journal.record(snap_id, region, "delete_snapshot", "deleted", image=ami_id)
+            del pending.in_use[region][snap_id]
+            pending.snapshot(region, snap_id)
+        except botocore.exceptions.ClientError as err1:
+            if err1.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
+                print("{} in region {} already gone, ok".format(snap_id, region))
+                logEvent(snap_id, region, "delete_snapshot", "gone", queued, retried=True)
+                if journal is not None:
+                    journal.record(snap_id, region, "delete_snapshot", "gone", image=ami_id)
+                del pending.in_use[region][snap_id]
+            elif err1.response["Error"]["Code"] != "InvalidSnapshot.InUse":
+                raise
+
+
+def pollRegion(client, region, pending, journal=None):
+    # One multi-ID describe per kind per region each round
+    ami_ids = sorted(pending.images.get(region, {}))
+    if len(ami_ids) > 0:
+        remaining = remainingImages(client, ami_ids)
+        for ami_id in ami_ids:
+            if ami_id not in remaining:
+                logEvent(ami_id, region, "verify_deregister", "confirmed", pending.images[region].pop(ami_id))
+    retryInUse(client, region, pending, journal)
+    snap_ids = sorted(pending.snapshots.get(region, {}))
+    if len(snap_ids) > 0:
+        remaining = remainingSnapshots(client, snap_ids)
+        for snap_id in snap_ids:
+            if snap_id not in remaining:
+                logEvent(snap_id, region, "verify_delete_snapshot", "confirmed", pending.snapshots[region].pop(snap_id))
+
+
+def verifyDeletions(client_map, pending, timeout=300, first_delay=1, max_delay=30, journal=None):
+    print("verifyDeletions entry, {} deletions to confirm".format(pending.count()))
+    deadline = time.monotonic() + timeout
+    delay = 0
+    polls = 0
+    while pending.count() > 0:
+        remaining_time = deadline - time.monotonic()
+        if polls > 0 and remaining_time <= 0:
+            break
+        time.sleep(min(delay, max(0, remaining_time)))
+        polls += 1
+        for region in pending.regions():
+            try:
+                pollRegion(client_map[region], region, pending, journal)
+            except botocore.exceptions.ClientError as err1:
+                print("Try of verifying deletions in region {} error: {}".format(region, err1))
+        print("Poll {}: {} deletions still unconfirmed".format(polls, pending.count()))
+        delay = first_delay if delay == 0 else min(delay * 2, max_delay)
+    for region in pending.regions():
+        for kind, resources in [("image", pending.images), ("snapshot", pending.snapshots), ("in-use snapshot", pending.in_use)]:
+            for resource_id in sorted(resources.get(region, {})):
+                print("Couldn't confirm {} {} in region {} is gone".format(kind, resource_id, region))
+                logEvent(resource_id, region, "verify_deletion", "unconfirmed", kind=kind)
+    success = pending.count() == 0
+    print("verifyDeletions exit after {} polls, returning {}".format(polls, success))
+    return success
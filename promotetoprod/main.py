@@ -1,95 +1,273 @@
 import os
-import boto3
-import json
-from io import StringIO
-import sys
 import base64
+import hashlib
+import json
+import time
+import boto3.exceptions
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from amimgmt.clients import loginS3Client, newClientPool, newSession
+from amimgmt.inputs import env_set, envFlag
+from amimgmt.log import logEvent, startLog, stopLog
+from amimgmt.metrics import Metrics
+from amimgmt.s3 import splitS3URI
+from amimgmt.snapshot import loadSnapshotIndex
+
+HEAD_WORKERS = 16
+# The largest object copy_object copies in one request
+MAX_COPY_OBJECT = 5 * 1024 * 1024 * 1024
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class HashingReader:
+    """A streaming GET body that hashes the bytes as they're read from it.
+
+    upload_fileobj reads a non-seekable source front to back, so the SHA-256
+    and MD5 digests come for free with the transfer.  Running out before the
+    expected length raises, which aborts the upload instead of completing it
+    short.
+    """
+
+    def __init__(self, body, expected_length):
+        self.body = body
+        self.expected_length = expected_length
+        self.length = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        chunk = self.body.read(size) if size is not None and size >= 0 else self.body.read()
+        self.length += len(chunk)
+        self.sha256.update(chunk)
+        self.md5.update(chunk)
+        if (len(chunk) == 0 or size is None or size < 0) and self.length != self.expected_length:
+            raise IntegrityError("read {} bytes, expected {}".format(self.length, self.expected_length))
+        return chunk
+
+
+def canReadSource(prod_client, bucket, obj, readable):
+    # Read access comes from the dev bucket's policy, not the key, so the
+    # first object probed answers for the whole bucket
+    if bucket not in readable:
+        try:
+            prod_client.head_object(Bucket=bucket, Key=obj)
+            readable.update({bucket: True})
+        except botocore.exceptions.ClientError as err1:
+            if err1.response["Error"]["Code"] not in ["403", "AccessDenied"]:
+                raise
+            readable.update({bucket: False})
+    return readable[bucket]
+
+
+def headS3Object(client, bucket, obj):
+    try:
+        return client.head_object(Bucket=bucket, Key=obj, ChecksumMode="ENABLED")
+    except botocore.exceptions.ClientError as err1:
+        if err1.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return None
+        raise
 
 
-def env_set(env_var, default):
-    if env_var in os.environ:
-        return os.environ[env_var]
-    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
-        with open(env_var, "r") as env_file:
-            var = env_file.read().strip()
-            env_file.close()
-        return var
+def headS3Objects(client, bucket_objs):
+    # S3 has no batch HEAD, so fan the requests out over a few threads instead
+    with ThreadPoolExecutor(max_workers=HEAD_WORKERS) as executor:
+        return list(executor.map(lambda bucket_obj: headS3Object(client, bucket_obj[0], bucket_obj[1]), bucket_objs))
+
+
+def sameS3Object(source, destination):
+    # A multipart copy gets a different ETag from its single-part source, so
+    # every transfer records the source ETag on the prod object as well
+    if destination is None or destination["ContentLength"] != source["ContentLength"]:
+        return False
+    return source["ETag"] in [destination["ETag"], destination.get("Metadata", {}).get("source-etag")]
+
+
+def fullObjectSHA256(head):
+    # Multipart uploads carry a checksum of their part checksums ("...-N"),
+    # which can't be compared with a digest of the whole object
+    checksum = head.get("ChecksumSHA256", "")
+    if checksum == "" or "-" in checksum or head.get("ChecksumType", "FULL_OBJECT") != "FULL_OBJECT":
+        return None
+    return checksum
+
+
+def md5ETag(head):
+    # A single-part upload's ETag is the hex MD5 of the object, unless it was
+    # encrypted with SSE-KMS or SSE-C
+    etag = head.get("ETag", "").strip('"')
+    if etag == "" or "-" in etag or head.get("ServerSideEncryption", "").startswith("aws:kms") or "SSECustomerAlgorithm" in head:
+        return None
+    return etag
+
+
+def copyS3Object(dev_client, prod_client, bucket, obj, prod_bucket, source, transfer_config, readable):
+    # S3 checks a SHA-256 of every part it receives and keeps one on the prod
+    # object; whichever way the bytes travel, the digests go in the manifest
+    extra_args = {"Metadata": {"source-etag": source["ETag"]}, "ChecksumAlgorithm": "SHA256"}
+    if "ContentType" in source:
+        extra_args.update({"ContentType": source["ContentType"]})
+    source_sha256 = fullObjectSHA256(source)
+    entry = {"source_checksum_sha256": source_sha256}
+    if canReadSource(prod_client, bucket, obj, readable):
+        # S3 copies the bytes itself, using upload_part_copy for anything
+        # bigger than a part
+        extra_args.update({"MetadataDirective": "REPLACE"})
+        if source_sha256 is None and md5ETag(source) is not None and source["ContentLength"] <= MAX_COPY_OBJECT:
+            # The source's MD5 is the only digest there is to check against,
+            # and only a one-request copy gets an MD5 ETag too
+            prod_client.copy_object(CopySource={"Bucket": bucket, "Key": obj}, Bucket=prod_bucket, Key=obj, **extra_args)
+        else:
+            prod_client.copy({"Bucket": bucket, "Key": obj}, prod_bucket, obj, ExtraArgs=extra_args, Config=transfer_config)
+        destination = prod_client.head_object(Bucket=prod_bucket, Key=obj, ChecksumMode="ENABLED")
+        entry.update({"outcome": "copied", "prod_checksum_sha256": fullObjectSHA256(destination)})
+        if destination["ContentLength"] != source["ContentLength"]:
+            checked = None
+        elif source_sha256 is not None and fullObjectSHA256(destination) is not None:
+            checked = "sha256" if source_sha256 == fullObjectSHA256(destination) else None
+        elif md5ETag(source) is not None and md5ETag(destination) is not None:
+            checked = "md5" if md5ETag(source) == md5ETag(destination) else None
+        else:
+            # Multipart or encrypted ETags can't be compared, and a matching
+            # length proves nothing
+            checked = "etag" if destination["ETag"] == source["ETag"] else "unverified"
+        print("Copied {} from {} to {} server-side".format(obj, bucket, prod_bucket))
     else:
-        return default
+        # Prod can't read dev, so pipe the GET body straight into a multipart
+        # upload; only a bounded number of parts are ever held in memory
+        body = HashingReader(dev_client.get_object(Bucket=bucket, Key=obj)["Body"], source["ContentLength"])
+        prod_client.upload_fileobj(body, prod_bucket, obj, ExtraArgs=extra_args, Config=transfer_config)
+        sha256 = base64.b64encode(body.sha256.digest()).decode("ascii")
+        entry.update({"outcome": "streamed", "sha256": sha256, "md5": body.md5.hexdigest()})
+        if source_sha256 is not None:
+            checked = "sha256" if source_sha256 == sha256 else None
+        elif md5ETag(source) is not None:
+            checked = "md5" if md5ETag(source) == body.md5.hexdigest() else None
+        else:
+            # The digests are recorded, but there's nothing to compare them with
+            checked = "unverified"
+        print("Streamed {} from {} to {}, sha256 {}".format(obj, bucket, prod_bucket, sha256))
+    if checked is None:
+        # Don't leave a corrupt object where prod will serve it
+        prod_client.delete_object(Bucket=prod_bucket, Key=obj)
+        raise IntegrityError("{} in {} doesn't match its source; deleted it".format(obj, prod_bucket))
+    if checked == "unverified":
+        print("{} has no full-object SHA-256 or single-part MD5 to check the copy against; recorded as unverified".format(obj))
+    entry.update({"verified": checked})
+    return entry
 
 
-def moveS3s(snapshot_path, snapshot_date, dev_region, prod_region, prod_bucket):
+def moveS3s(index, dev_pool, prod_pool, dev_region, prod_bucket, transfer_config, incremental, manifest):
     return_code = False
-    dev_session = boto3.Session(profile_name="dev", region_name=dev_region)
-    prod_session = boto3.Session(profile_name="prod", region_name=prod_region)
-    resource_map = {}
+    if index.resources is None or "s3_files" not in index.resources:
+        print("Didn't find {}/resources-{}.json!".format(index.path, index.date))
+        return return_code
+    s3_files = index.resources["s3_files"]
+    return_code = True
+    dev_client = loginS3Client(dev_pool)
+    prod_client = loginS3Client(prod_pool)
+    bucket_objs = []
+    for entry in s3_files:
+        if "{}/".format(dev_region) in entry:
+            bucket_objs.append(splitS3URI(entry))
     try:
-        with open("{}/resources-{}.json".format(snapshot_path, snapshot_date), "r") as s3_file:
-            resource_text = s3_file.read()
-            resource_map = json.loads(resource_text)
-        s3_files = resource_map["s3_files"]
-        dev_client = dev_session.client("s3")
-        prod_client = prod_session.client("s3")
-        for entry in s3_files:
-            if "{}/".format(dev_region) in entry:
-                # Break up an S3 URI into usable bits i.e.
-                # s3://positronic-asimov-us-west-2/cdk/template-development-2022-07-12-10-44-52.json
-                #   bucket --> positronic-asimov-us-west-2
-                #      obj --> cdk/template-development-2022-07-12-10-44-52.json
-                parts = entry.split("s3://")
-                bucket = parts[1].split("/")[0]
-                start = len(bucket) + entry.find(bucket) + 1
-                obj = entry[start:]
-                file = obj.split("/")[1]
-                dev_client.download_file(bucket, obj, file)
-                print("Downloaded {} from {}".format(obj, bucket))
-                prod_client.upload_file(file, prod_bucket, obj)
-                print("Uploaded {} to {}".format(obj, prod_bucket))
-        return_code = True
-    except:
-        print("Didn't find {}/resources-{}.json!".format(snapshot_path, snapshot_date))
+        sources = headS3Objects(dev_client, bucket_objs)
+        if incremental:
+            destinations = headS3Objects(prod_client, [(prod_bucket, obj) for bucket, obj in bucket_objs])
+        else:
+            destinations = [None] * len(bucket_objs)
+    except botocore.exceptions.ClientError as err1:
+        print("Try of head_object error: {}".format(err1))
+        return False
+    bytes_skipped = 0
+    bytes_transferred = 0
+    readable = {}
+    region = prod_client.meta.region_name
+    for (bucket, obj), source, destination in zip(bucket_objs, sources, destinations):
+        resource = "s3://{}/{}".format(prod_bucket, obj)
+        entry = {"key": obj, "source": "s3://{}/{}".format(bucket, obj), "destination": resource}
+        if source is None:
+            print("Didn't find {} in {}!".format(obj, bucket))
+            logEvent(resource, region, "copy_object", "missing", source="s3://{}/{}".format(bucket, obj))
+            return_code = False
+        elif sameS3Object(source, destination):
+            print("Skipped {}, already identical in {}".format(obj, prod_bucket))
+            logEvent(resource, region, "copy_object", "skipped", bytes=source["ContentLength"])
+            bytes_skipped += source["ContentLength"]
+            entry.update(
+                {
+                    "outcome": "skipped",
+                    "bytes": source["ContentLength"],
+                    "source_checksum_sha256": fullObjectSHA256(source),
+                    "prod_checksum_sha256": fullObjectSHA256(destination),
+                }
+            )
+            manifest.append(entry)
+        else:
+            started = time.monotonic()
+            try:
+                entry.update(copyS3Object(dev_client, prod_client, bucket, obj, prod_bucket, source, transfer_config, readable))
+                entry.update({"bytes": source["ContentLength"]})
+                manifest.append(entry)
+                logEvent(resource, region, "copy_object", entry["outcome"], started, bytes=source["ContentLength"], verified=entry["verified"])
+                bytes_transferred += source["ContentLength"]
+            except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError, boto3.exceptions.S3UploadFailedError, IntegrityError) as err1:
+                print("Try of copying {} from {} to {} error: {}".format(obj, bucket, prod_bucket, err1))
+                logEvent(resource, region, "copy_object", "failed", started, error=str(err1))
+                return_code = False
+    print("Bytes skipped: {}, bytes transferred: {}".format(bytes_skipped, bytes_transferred))
     return return_code
 
 
-def loginS3Client():
-    client = boto3.client("s3")
-    return client
-
-
 def main():
 
-    # Reorient stdout to a string so we can capture it
-    tmp_stdout = sys.stdout
-    string_stdout = StringIO()
-    sys.stdout = string_stdout
-
-    # Assumes a credentials file has been laid down thusly
-    os.environ["AWS_SHARED_CREDENTIALS_FILE"] = "{}/.aws/credentials".format(os.getcwd())
+    # Stream stdout to the console and the log file as it's printed
+    log_filename = env_set("INPUT_LOG_FILENAME", "prod-promote.log")
+    metrics_filename = env_set("INPUT_METRICS_FILENAME", "") or "{}.metrics.json".format(os.path.splitext(log_filename)[0])
+    manifest_filename = env_set("INPUT_MANIFEST_FILENAME", "") or "{}.manifest.json".format(os.path.splitext(log_filename)[0])
+    metrics = Metrics()
+    startLog(log_filename, env_set("INPUT_EVENTS_FILENAME", ""), "a")
 
     # Prime the stdout pump - we seem to lose the first line otherwise
     print()
 
     snapshot_path = env_set("INPUT_SNAPSHOT_PATH", "")
     snapshot_date = env_set("INPUT_SNAPSHOT_DATE", "")
-    log_filename = env_set("INPUT_LOG_FILENAME", "prod-promote.log")
     dev_region = env_set("INPUT_AWS_DEV_ENDPOINT_REGION", "us-east-2")
     prod_region = env_set("INPUT_AWS_PROD_ENDPOINT_REGION", "us-east-2")
     prod_s3_bucket = env_set("INPUT_AWS_PROD_S3_BUCKET", "aap-aoc-code-assets")
+    part_size = int(env_set("INPUT_PART_SIZE_MB", "64")) * 1024 * 1024
+    transfer_concurrency = max(1, int(env_set("INPUT_TRANSFER_CONCURRENCY", "4")))
+    incremental = envFlag("INPUT_INCREMENTAL", "true")
     aws_creds_text = base64.b64decode(os.environ["INPUT_AWS_SHARED_CREDS_BASE64"]).decode("utf-8")
     creds_path = "{}/.aws".format(os.getcwd())
-    os.mkdir(creds_path)
+    os.makedirs(creds_path, exist_ok=True)
     creds_file = "{}/credentials".format(creds_path)
     with open(creds_file, "w") as out_file:
         out_file.write(aws_creds_text)
         out_file.close()
 
-    success = moveS3s(snapshot_path, snapshot_date, dev_region, prod_region, prod_s3_bucket)
+    # Dev and prod are separate accounts with separate quotas, so each pool gets its own limiter
+    dev_pool = newClientPool(newSession(region=dev_region, profile="dev", credentials_file=creds_file), metrics)
+    prod_pool = newClientPool(newSession(region=prod_region, profile="prod", credentials_file=creds_file), metrics)
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=transfer_concurrency,
+    )
+    # Cap how many parts of a streamed (non-seekable) upload sit in memory
+    transfer_config.max_in_memory_upload_chunks = transfer_concurrency
+    manifest = []
+    success = moveS3s(loadSnapshotIndex(snapshot_path, snapshot_date), dev_pool, prod_pool, dev_region, prod_s3_bucket, transfer_config, incremental, manifest)
+    with open(manifest_filename, "w") as out_file:
+        json.dump({"snapshot_date": snapshot_date, "bucket": prod_s3_bucket, "objects": manifest}, out_file, indent=4)
+    print("Wrote promotion manifest to {}".format(manifest_filename))
 
-    # Reorient stdout back to normal, dump out what it was, and return value to action
-    sys.stdout = tmp_stdout
-    with open(log_filename, "a") as out_file:
-        out_file.write(string_stdout.getvalue())
-        out_file.close()
+    metrics.report(metrics_filename, "promotetoprod")
+    stopLog()
     exit(not success)
 
 
@@ -0,0 +1,63 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, and bursts of up to burst.
+
+    acquire() reserves a token under the lock and then sleeps off any debt
+    outside it, so waiting threads queue up in arrival order without holding
+    each other up.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Token buckets for one client pool, one per (service, region).
+
+    AWS meters request rates per account, region and API family, and each
+    pool is one account, so newClientPool gives every pool a limiter of its
+    own.  Every client in the pool talking to the same service in the same
+    region draws from the same bucket however many threads share it.  The
+    hook fires before each HTTP attempt, so botocore's retries are paced too.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service, region):
+        with self._lock:
+            key = (service, region)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return self._buckets[key]
+
+    def watch(self, client):
+        bucket = self.bucket(client.meta.service_model.service_name, client.meta.region_name)
+
+        def beforeSend(**kwargs):
+            bucket.acquire()
+
+        # First, so a stubbed or short-circuited send is still paced
+        client.meta.events.register_first("before-send", beforeSend)
+        return client
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class CallStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, error, retries):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.retries += retries
+        self.seconds += seconds
+        self.slowest = max(self.slowest, seconds)
+        for bucket, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            bucket = len(BUCKETS)
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction):
+        # The upper bound of the bucket the percentile falls in
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(BUCKETS[bucket], self.slowest) if bucket < len(BUCKETS) else self.slowest
+        return self.slowest
+
+
+class Metrics:
+    """Count, errors, retries and latency per (service, operation, region).
+
+    watch() hooks a client's before-call and after-call events, so every call
+    is timed from the first attempt to the parsed response, retries and
+    rate-limiter waits included.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.clients = {}
+        self.started = time.monotonic()
+        # CPU spent before the action got going, mostly importing boto3
+        self.startup_cpu_seconds = time.process_time()
+        self._lock = threading.Lock()
+
+    def watch(self, client):
+        client.meta.events.register("before-call", self.beforeCall, unique_id="amimgmt-metrics-before")
+        client.meta.events.register("after-call", self.afterCall, unique_id="amimgmt-metrics-after")
+        client.meta.events.register("after-call-error", self.afterCallError, unique_id="amimgmt-metrics-error")
+        return client
+
+    def beforeCall(self, context, **kwargs):
+        context["amimgmt_started"] = time.monotonic()
+
+    def afterCall(self, http_response, parsed, model, context, **kwargs):
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        self.record(model.service_model.service_name, model.name, context, http_response.status_code >= 300, retries)
+
+    def afterCallError(self, event_name, context, **kwargs):
+        # Raised before any response was parsed (e.g. retries exhausted on a
+        # connection error); only the event name says which call it was
+        service, operation = event_name.split(".")[1:3]
+        self.record(service, operation, context, True, 0)
+
+    def record(self, service, operation, context, error, retries):
+        seconds = time.monotonic() - context.get("amimgmt_started", time.monotonic())
+        key = (service, operation, context.get("client_region"))
+        with self._lock:
+            if key not in self.stats:
+                self.stats[key] = CallStats()
+            self.stats[key].add(seconds, error, retries)
+
+    def clientCreated(self, service, region, seconds):
+        with self._lock:
+            self.clients[(service, region)] = seconds
+
+    def totals(self):
+        with self._lock:
+            stats = list(self.stats.values())
+            client_seconds = list(self.clients.values())
+        return {
+            "calls": sum(call_stats.count for call_stats in stats),
+            "errors": sum(call_stats.errors for call_stats in stats),
+            "retries": sum(call_stats.retries for call_stats in stats),
+            "api_seconds": round(sum(call_stats.seconds for call_stats in stats), 3),
+            "clients": len(client_seconds),
+            "client_seconds": round(sum(client_seconds), 3),
+            "startup_cpu_seconds": round(self.startup_cpu_seconds, 3),
+            "wall_seconds": round(time.monotonic() - self.started, 3),
+        }
+
+    def rows(self):
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: (item[0][0], item[0][1], item[0][2] or ""))
+        rows = []
+        for (service, operation, region), call_stats in items:
+            histogram = {"le_{}".format(bound): count for bound, count in zip(BUCKETS, call_stats.histogram)}
+            histogram.update({"le_inf": call_stats.histogram[-1]})
+            rows.append(
+                {
+                    "service": service,
+                    "operation": operation,
+                    "region": region,
+                    "count": call_stats.count,
+                    "errors": call_stats.errors,
+                    "retries": call_stats.retries,
+                    "seconds": round(call_stats.seconds, 3),
+                    "mean": round(call_stats.seconds / call_stats.count, 4),
+                    "p50": call_stats.percentile(0.5),
+                    "p95": call_stats.percentile(0.95),
+                    "max": round(call_stats.slowest, 4),
+                    "histogram": histogram,
+                }
+            )
+        return rows
+
+    def writeJSON(self, filename):
+        with open(filename, "w") as out_file:
+            with self._lock:
+                clients = [{"service": key[0], "region": key[1], "seconds": round(self.clients[key], 4)} for key in sorted(self.clients)]
+            json.dump({"totals": self.totals(), "calls": self.rows(), "clients": clients}, out_file, indent=4)
+
+    def writeSummary(self, title):
+        # Appended to the job's summary page when run inside GitHub Actions
+        if "GITHUB_STEP_SUMMARY" not in os.environ:
+            return
+        totals = self.totals()
+        lines = [
+            "### {} AWS API calls".format(title),
+            "",
+            "{} calls, {} errors, {} retries, {}s in API calls, {}s wall time".format(
+                totals["calls"], totals["errors"], totals["retries"], totals["api_seconds"], totals["wall_seconds"]
+            ),
+            "",
+            "{} clients created in {}s, {}s CPU at startup".format(totals["clients"], totals["client_seconds"], totals["startup_cpu_seconds"]),
+            "",
+            "| Service | Operation | Region | Calls | Errors | Retries | Total s | Mean s | p50 s | p95 s | Max s |",
+            "|---|---|---|---:|---:|---:|---:|---:|---:|---:|---:|",
+        ]
+        for row in self.rows():
+            lines.append("| {service} | {operation} | {region} | {count} | {errors} | {retries} | {seconds} | {mean} | {p50} | {p95} | {max} |".format(**row))
+        with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as out_file:
+            out_file.write("\n".join(lines) + "\n\n")
+
+    def writeOutputs(self, metrics_filename):
+        if "GITHUB_OUTPUT" not in os.environ:
+            return
+        totals = self.totals()
+        with open(os.environ["GITHUB_OUTPUT"], "a") as out_file:
+            out_file.write("api_calls={}\n".format(totals["calls"]))
+            out_file.write("api_errors={}\n".format(totals["errors"]))
+            out_file.write("api_retries={}\n".format(totals["retries"]))
+            out_file.write("api_seconds={}\n".format(totals["api_seconds"]))
+            out_file.write("metrics_file={}\n".format(metrics_filename))
+
+    def report(self, metrics_filename, title):
+        totals = self.totals()
+        print(
+            "AWS API calls: {}, errors: {}, retries: {}, seconds in API calls: {}, clients created: {} in {}s".format(
+                totals["calls"], totals["errors"], totals["retries"], totals["api_seconds"], totals["clients"], totals["client_seconds"]
+            )
+        )
+        self.writeJSON(metrics_filename)
+        self.writeSummary(title)
+        self.writeOutputs(metrics_filename)
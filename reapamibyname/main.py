@@ -1,141 +1,390 @@
 import os
-import boto3
 import botocore.exceptions
+import datetime
 import json
+import heapq
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
-import sys
+from amimgmt.clients import loginEC2Clients, newClientPool, newSession, whoami
+from amimgmt.ec2 import PROMOTION_TAG, findTagged, imageSnapshots
+from amimgmt.inputs import env_set
+from amimgmt.inventory import Inventory
+from amimgmt.log import logEvent, startLog, stopLog
+from amimgmt.metrics import Metrics
+from amimgmt.verify import PendingDeletions, verifyDeletions
 
 
-def env_set(env_var, default):
-    if env_var in os.environ:
-        return os.environ[env_var]
-    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
-        with open(env_var, "r") as env_file:
-            var = env_file.read().strip()
-            env_file.close()
-        return var
-    else:
-        return default
-
-
-def loginEC2Clients(ami_map):
-    client_map = {}
-    for region in ami_map:
-        os.environ["AWS_DEFAULT_REGION"] = region
-        client = boto3.client("ec2")
-        element = {region: client}
-        client_map.update(element)
-    return client_map
+def nameMatcher(ami_names):
+    # EC2 name filters only treat * and ? as wildcards; anything else,
+    # square brackets included, is literal
+    patterns = [re.escape(ami_name).replace("\\*", ".*").replace("\\?", ".") for ami_name in ami_names]
+    return re.compile("^(?:{})$".format("|".join(patterns)), re.DOTALL)
 
 
-def findAMIs(client_map, ami_name):
+def findAMIs(client_map, ami_names, inventory=None):
+    # region -> {ami_id: [snap_id, ...]}, so every match and every EBS
+    # snapshot behind it survives, however many there are
     ami_map = {}
-    snap_map = {}
+    success = True
+    matcher = nameMatcher(ami_names)
     for region in client_map:
         client = client_map[region]
+        images = {}
         try:
-            response = client.describe_images(Filters=[{"Name": "name", "Values": [ami_name]}])
-            # print(json.dumps(response, indent=4))
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                for image in response["Images"]:
-                    # print(json.dumps(image, indent=4))
-                    element = {region: image["ImageId"]}
-                    ami_map.update(element)
-                    # print(json.dumps(element, indent=4))
-                    for blockDeviceMap in image["BlockDeviceMappings"]:
-                        snap = blockDeviceMap["Ebs"]["SnapshotId"]
-                        element = {region: snap}
-                        snap_map.update(element)
-        except:
-            print("Nope, AMI {} isn't in this region, so we can't look up its snaps".format(ami_map[region]))
-    return ami_map, snap_map
-
-
-def deleteAMIs(client_map, ami_map):
-    print("deleteAMIs entry")
+            if inventory is not None:
+                for image in inventory.images(client, region).values():
+                    if matcher.match(image.get("Name", "")):
+                        images.update({image["ImageId"]: image})
+            else:
+                paginator = client.get_paginator("describe_images")
+                for page in paginator.paginate(Owners=["self"], Filters=[{"Name": "name", "Values": ami_names}]):
+                    for image in page["Images"]:
+                        images.update({image["ImageId"]: image})
+        except botocore.exceptions.ClientError as err1:
+            print("Try of describe_images in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+            success = False
+            continue
+        if len(images) == 0:
+            continue
+        ami_map.update({region: {}})
+        for ami_id in sorted(images):
+            snaps = imageSnapshots(images[ami_id])
+            ami_map[region].update({ami_id: snaps})
+    return success, ami_map
+
+
+def findExpiredAMIs(client, region, family_pattern, retention_keep, retention_older_than, inventory=None):
+    # Each family's newest retention_keep images are held in a min-heap while
+    # paging; whatever drops out of it is past the limit, so only N images
+    # per family are ever kept in memory
+    keep = None if retention_keep == "" else int(retention_keep)
+    matcher = re.compile(family_pattern)
+    newest = {}
+    expired = {}
+    protected = []
+    if inventory is not None:
+        images = inventory.images(client, region).values()
+    else:
+        images = (image for page in client.get_paginator("describe_images").paginate(Owners=["self"]) for image in page["Images"])
+    for image in images:
+        match = matcher.match(image.get("Name", ""))
+        if match is None:
+            continue
+        if {"Key": PROMOTION_TAG, "Value": "deployed"} in image.get("Tags", []):
+            protected.append(image["ImageId"])
+            continue
+        family = match.group(1) if matcher.groups > 0 else match.group(0)
+        snaps = imageSnapshots(image)
+        entry = (image["CreationDate"], image["ImageId"], snaps)
+        if keep is None:
+            dropped = [entry]
+        else:
+            heap = newest.setdefault(family, [])
+            heapq.heappush(heap, entry)
+            dropped = [heapq.heappop(heap)] if len(heap) > keep else []
+        for creation_date, ami_id, snaps in dropped:
+            if retention_older_than == "" or creation_date < retention_older_than:
+                expired.update({ami_id: snaps})
+    if inventory is not None and len(expired) > 0:
+        # Cached tags can be up to inventory_ttl old; ask EC2 again before
+        # anything is deregistered
+        for ami_id in sorted(findTagged(client, sorted(expired), "deployed")):
+            del expired[ami_id]
+            protected.append(ami_id)
+    kept = {family: sorted(entry[1] for entry in newest[family]) for family in newest}
+    return expired, kept, protected
+
+
+def findRetention(client_map, family_pattern, retention_keep, retention_older_than, max_workers, inventory=None):
+    print("findRetention entry, family is {}, keep is {}, older than {}".format(family_pattern, retention_keep, retention_older_than))
+    success = True
+    ami_map = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            region: executor.submit(findExpiredAMIs, client_map[region], region, family_pattern, retention_keep, retention_older_than, inventory)
+            for region in client_map
+        }
+        for region in futures:
+            try:
+                expired, kept, protected = futures[region].result()
+            except botocore.exceptions.ClientError as err1:
+                print("Try of describe_images in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
+                success = False
+                continue
+            for family in sorted(kept):
+                print("Region {} family {}: keeping {}".format(region, family, ", ".join(kept[family])))
+            for ami_id in protected:
+                print("Region {}: {} is tagged {}=deployed, keeping".format(region, ami_id, PROMOTION_TAG))
+            if len(expired) > 0:
+                ami_map.update({region: {ami_id: expired[ami_id] for ami_id in sorted(expired)}})
+    print("findRetention exit, returning {}".format(success))
+    return success, ami_map
+
+
+def deleteAMIs(client_map, ami_map, pending=None, out=None):
+    print("deleteAMIs entry", file=out)
     success = True
+    reaped = {}
     for region in ami_map:
-        try:
-            print("Looking for {} in region {}:".format(ami_map[region], region))
-            client_map[region].describe_images(ImageIds=[ami_map[region]])
+        reaped.update({region: []})
+        for ami_id in ami_map[region]:
+            print("Looking for {} in region {}:".format(ami_id, region), file=out)
+            started = time.monotonic()
             try:
-                response = client_map[region].deregister_image(ImageId=ami_map[region], DryRun=False)
+                response = client_map[region].deregister_image(ImageId=ami_id, DryRun=False)
                 if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                    print("Deleted, ok")
+                    print("Deleted, ok", file=out)
+                    logEvent(ami_id, region, "deregister_image", "deleted", started)
+                    if pending is not None:
+                        pending.image(region, ami_id)
                 else:
-                    print(json.dumps(response, indent=4))
+                    print(json.dumps(response, indent=4), file=out)
+                    logEvent(ami_id, region, "deregister_image", "unknown", started)
+                reaped[region].append(ami_id)
             except botocore.exceptions.ClientError as err2:
                 if err2.response["Error"]["Code"] == "DryRunOperation":
-                    print("Dry run, ok")
-                elif err2.response["Error"]["Code"] == "InvalidAMIID.Unavailable":
-                    print("Already gone, ok")
+                    print("Dry run, ok", file=out)
+                    logEvent(ami_id, region, "deregister_image", "dry-run", started)
+                elif err2.response["Error"]["Code"] in ["InvalidAMIID.Unavailable", "InvalidAMIID.NotFound"]:
+                    print("Already gone, ok", file=out)
+                    logEvent(ami_id, region, "deregister_image", "gone", started)
+                    reaped[region].append(ami_id)
                 else:
-                    print("Try of deregister_image error: {}".format(err2))
+                    print("Try of deregister_image error: {}".format(err2), file=out)
+                    logEvent(ami_id, region, "deregister_image", "failed", started, error=err2.response["Error"]["Code"])
                     success = False
-        except botocore.exceptions.ClientError as err1:
-            if err1.response["Error"]["Code"] == "InvalidAMIID.NotFound":
-                print("AMI no longer present; continuing.")
-            else:
-                print("Try of describe_images error: {}\n{}".format(json.dumps(err1.response, indent=4), err1))
+    print("deleteAMIs exit, returning {}".format(success), file=out)
+    return success, reaped
+
+
+def deleteSNAPs(client_map, ami_map, reaped, pending=None, out=None):
+    # Only snapshots of AMIs that are really gone; a registered AMI still
+    # holds its snapshots in use
+    print("deleteSNAPs entry", file=out)
+    success = True
+    for region in reaped:
+        for ami_id in reaped[region]:
+            for snap in ami_map[region][ami_id]:
+                started = time.monotonic()
+                try:
+                    print("Looking for {} in region {}:".format(snap, region), file=out)
+                    response = client_map[region].delete_snapshot(SnapshotId=snap, DryRun=False)
+                    if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
+                        print("Deleted, ok", file=out)
+                        logEvent(snap, region, "delete_snapshot", "deleted", started, image=ami_id)
+                        if pending is not None:
+                            pending.snapshot(region, snap)
+                    else:
+                        print(json.dumps(response, indent=4), file=out)
+                        logEvent(snap, region, "delete_snapshot", "unknown", started, image=ami_id)
+                except botocore.exceptions.ClientError as err2:
+                    if err2.response["Error"]["Code"] == "DryRunOperation":
+                        print("Dry run, ok", file=out)
+                        logEvent(snap, region, "delete_snapshot", "dry-run", started, image=ami_id)
+                    elif err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
+                        print("Already gone, ok", file=out)
+                        logEvent(snap, region, "delete_snapshot", "gone", started, image=ami_id)
+                    elif err2.response["Error"]["Code"] == "InvalidSnapshot.InUse" and pending is not None:
+                        print("In use, retrying once {} is gone".format(ami_id), file=out)
+                        logEvent(snap, region, "delete_snapshot", "in-use", started, image=ami_id)
+                        pending.inUse(region, snap, ami_id)
+                    else:
+                        print("Try of delete_snapshot error: {}\n{}".format(json.dumps(err2.response, indent=4), err2), file=out)
+                        logEvent(snap, region, "delete_snapshot", "failed", started, image=ami_id, error=err2.response["Error"]["Code"])
+                        success = False
+    print("deleteSNAPs exit, returning {}".format(success), file=out)
+    return success
+
+
+def reapRegion(client_map, region, ami_map, pending):
+    # Buffer each region's transcript so concurrent regions don't interleave
+    out = StringIO()
+    amis_success, reaped = deleteAMIs(client_map, {region: ami_map[region]}, pending, out)
+    snaps_success = deleteSNAPs(client_map, ami_map, reaped, pending, out)
+    return amis_success and snaps_success, out.getvalue()
+
+
+def reapRegions(client_map, ami_map, pending, max_workers):
+    print("reapRegions entry, max_workers is {}".format(max_workers))
+    success = True
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(reapRegion, client_map, region, ami_map, pending) for region in ami_map]
+        for future in futures:
+            region_success, transcript = future.result()
+            print(transcript, end="")
+            if not region_success:
                 success = False
-    print("deleteAMIs exit, returning {}".format(success))
+    print("reapRegions exit, returning {}".format(success))
     return success
 
 
-def deleteSNAPs(client_map, snap_map):
-    print("deleteSNAPs entry")
+def referencedSnapshots(client, include_disabled):
+    referenced = set()
+    params = {"Owners": ["self"], "IncludeDeprecated": True}
+    if include_disabled:
+        params.update({"IncludeDisabled": True})
+    paginator = client.get_paginator("describe_images")
+    for page in paginator.paginate(**params):
+        for image in page["Images"]:
+            referenced.update(imageSnapshots(image))
+    return referenced
+
+
+def findOrphans(client, region, min_age_days, description_pattern):
+    # Index every snapshot an AMI refers to, then stream the account's
+    # snapshots past it a page at a time.  Only IDs are kept, so memory
+    # stays small however many snapshots the account holds.
+    complete = True
+    try:
+        referenced = referencedSnapshots(client, True)
+    except botocore.exceptions.ParamValidationError:
+        # botocore from before 2023, all pip finds for the Python 3.6 image,
+        # can't ask for disabled AMIs, so their snapshots would look orphaned
+        referenced = referencedSnapshots(client, False)
+        complete = False
+    # Younger snapshots may belong to an AMI registered after the images were listed
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=min_age_days)
+    matcher = re.compile(description_pattern)
+    scanned = 0
+    orphans = []
+    paginator = client.get_paginator("describe_snapshots")
+    for page in paginator.paginate(OwnerIds=["self"], PaginationConfig={"PageSize": 1000}):
+        for snapshot in page["Snapshots"]:
+            scanned += 1
+            if snapshot["SnapshotId"] in referenced or snapshot["State"] != "completed" or snapshot["StartTime"] > cutoff:
+                continue
+            if matcher.search(snapshot.get("Description", "")):
+                orphans.append([snapshot["SnapshotId"], snapshot["StartTime"].date().isoformat(), snapshot.get("Description", "")])
+    return scanned, len(referenced), orphans, complete
+
+
+def scanOrphans(client_map, max_workers, min_age_days, description_pattern):
+    print("scanOrphans entry, max_workers is {}, min_age_days is {}".format(max_workers, min_age_days))
     success = True
-    for region in snap_map:
-        try:
-            print("Looking for {} in region {}:".format(snap_map[region], region))
-            response = client_map[region].delete_snapshot(SnapshotId=snap_map[region], DryRun=False)
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                print("Deleted, ok")
-            else:
-                print(json.dumps(response, indent=4))
-        except botocore.exceptions.ClientError as err2:
-            if err2.response["Error"]["Code"] == "DryRunOperation":
-                print("Dry run, ok")
-            elif err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
-                print("Already gone, ok")
-            else:
-                print("Try of delete_snapshot error: {}\n{}".format(json.dumps(err2.response, indent=4), err2))
+    orphan_map = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {region: executor.submit(findOrphans, client_map[region], region, min_age_days, description_pattern) for region in client_map}
+        for region in futures:
+            try:
+                scanned, referenced, orphans, complete = futures[region].result()
+            except botocore.exceptions.ClientError as err1:
+                print("Try of orphan scan in region {} error: {}\n{}".format(region, json.dumps(err1.response, indent=4), err1))
                 success = False
-    print("deleteSNAPs exit, returning {}".format(success))
+                continue
+            print("Region {}: {} snapshots, {} referenced by AMIs, {} orphaned".format(region, scanned, referenced, len(orphans)))
+            for snap, start_date, description in orphans:
+                print("Orphan {} from {}: {}".format(snap, start_date, description))
+                logEvent(snap, region, "orphan_scan", "orphaned", description=description, start_date=start_date)
+            if not complete:
+                print("Region {}: this botocore can't list disabled AMIs, so these orphans are only reported, not reaped".format(region))
+            elif len(orphans) > 0:
+                orphan_map.update({region: [orphan[0] for orphan in orphans]})
+    print("scanOrphans exit, returning {}".format(success))
+    return success, orphan_map
+
+
+def deleteOrphans(client_map, orphan_map, pending=None):
+    print("deleteOrphans entry")
+    success = True
+    for region in orphan_map:
+        for snap in orphan_map[region]:
+            started = time.monotonic()
+            try:
+                print("Looking for {} in region {}:".format(snap, region))
+                client_map[region].delete_snapshot(SnapshotId=snap, DryRun=False)
+                print("Deleted, ok")
+                logEvent(snap, region, "delete_snapshot", "deleted", started, orphan=True)
+                if pending is not None:
+                    pending.snapshot(region, snap)
+            except botocore.exceptions.ClientError as err2:
+                if err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
+                    print("Already gone, ok")
+                    logEvent(snap, region, "delete_snapshot", "gone", started, orphan=True)
+                elif err2.response["Error"]["Code"] == "InvalidSnapshot.InUse":
+                    # An AMI was registered from it since the scan
+                    print("In use now, skipping")
+                    logEvent(snap, region, "delete_snapshot", "in-use", started, orphan=True)
+                else:
+                    print("Try of delete_snapshot error: {}\n{}".format(json.dumps(err2.response, indent=4), err2))
+                    logEvent(snap, region, "delete_snapshot", "failed", started, orphan=True, error=err2.response["Error"]["Code"])
+                    success = False
+    print("deleteOrphans exit, returning {}".format(success))
     return success
 
 
 def main():
 
-    # Reorient stdout to a string so we can capture it
-    tmp_stdout = sys.stdout
-    string_stdout = StringIO()
-    sys.stdout = string_stdout
+    # Stream stdout to the console and the log file as it's printed
+    log_filename = env_set("INPUT_LOG_FILENAME", "reaper.log")
+    metrics_filename = env_set("INPUT_METRICS_FILENAME", "") or "{}.metrics.json".format(os.path.splitext(log_filename)[0])
+    metrics = Metrics()
+    startLog(log_filename, env_set("INPUT_EVENTS_FILENAME", ""))
 
-    os.environ["AWS_ACCESS_KEY_ID"] = env_set("INPUT_AWS_ACCESS_KEY_ID", "")
-    os.environ["AWS_SECRET_ACCESS_KEY"] = env_set("INPUT_AWS_SECRET_ACCESS_KEY", "")
-    os.environ["AWS_DEFAULT_REGION"] = env_set("INPUT_AWS_REGION", "us-east-2")
+    session = newSession(
+        env_set("INPUT_AWS_ACCESS_KEY_ID", ""),
+        env_set("INPUT_AWS_SECRET_ACCESS_KEY", ""),
+        env_set("INPUT_AWS_REGION", "us-east-2"),
+    )
+    client_pool = newClientPool(session, metrics)
 
     ami_name = env_set("INPUT_AMI_NAME", "").strip()
+    # Several names (or patterns) may be given, one per line or comma separated
+    ami_names = [name.strip() for name in re.split("[,\n]", ami_name) if name.strip() != ""]
     aws_regions = env_set("INPUT_AWS_REGIONS", "")
+    inventory_cache = env_set("INPUT_INVENTORY_CACHE", "")
+    inventory_ttl = int(env_set("INPUT_INVENTORY_TTL", "900"))
+    verify_timeout = int(env_set("INPUT_VERIFY_TIMEOUT", "300"))
+    max_workers = max(1, int(env_set("INPUT_MAX_WORKERS", "8")))
+    orphan_scan = env_set("INPUT_ORPHAN_SCAN", "").strip().lower()
+    orphan_min_age_days = int(env_set("INPUT_ORPHAN_MIN_AGE_DAYS", "7"))
+    orphan_description = env_set("INPUT_ORPHAN_DESCRIPTION", "ami-[0-9a-f]+")
+    retention_family = env_set("INPUT_RETENTION_FAMILY", "")
+    retention_keep = env_set("INPUT_RETENTION_KEEP", "")
+    retention_older_than = env_set("INPUT_RETENTION_OLDER_THAN", "")
 
-    regions = aws_regions.split(" ")
-    ec2_client_map = loginEC2Clients(regions)
-    ami_map, snap_map = findAMIs(ec2_client_map, ami_name)
-    # snap_map = findSNAPs(ec2_client_map, ami_map)
-    print("\nReport for AMI name {}:".format(ami_name))
+    inventory = None
+    if inventory_cache != "":
+        inventory = Inventory(inventory_cache, whoami(client_pool), inventory_ttl)
+    regions = aws_regions.split()
+    ec2_client_map = loginEC2Clients(client_pool, regions, inventory)
+    success, ami_map = True, {}
+    if orphan_scan not in ["", "report", "reap"]:
+        print("orphan_scan must be report or reap, not {}; not reaping anything".format(orphan_scan))
+        success = False
+    elif retention_family != "" and retention_keep == "" and retention_older_than == "":
+        print("Retention by family needs retention_keep and/or retention_older_than; not reaping anything")
+        success = False
+    else:
+        if len(ami_names) > 0:
+            success, ami_map = findAMIs(ec2_client_map, ami_names, inventory)
+        elif orphan_scan == "" and retention_family == "":
+            print("No AMI name given; not reaping anything")
+            success = False
+        if retention_family != "":
+            retention_success, retention_map = findRetention(ec2_client_map, retention_family, retention_keep, retention_older_than, max_workers, inventory)
+            for region in retention_map:
+                ami_map.setdefault(region, {}).update(retention_map[region])
+            success = success and retention_success
+    print("\nReport for AMI name(s) {}:".format(", ".join(ami_names)))
+    print("Found {} AMIs in {} regions".format(sum(len(ami_map[region]) for region in ami_map), len(ami_map)))
     print("AMI map:\n{}".format(json.dumps(ami_map, indent=4)))
-    print("SNAP map:\n{}".format(json.dumps(snap_map, indent=4)))
-    success = False
-    success = deleteAMIs(ec2_client_map, ami_map)
-    if success:
-        success = deleteSNAPs(ec2_client_map, snap_map)
-
-    # Reorient stdout back to normal, dump out what it was, and return value to action
-    sys.stdout = tmp_stdout
-    with open("reaper.log", "w") as out_file:
-        out_file.write(string_stdout.getvalue())
-        out_file.close()
+    pending = None if verify_timeout <= 0 else PendingDeletions()
+    success = reapRegions(ec2_client_map, ami_map, pending, max_workers) and success
+    # After the by-name reap, so the snapshots it just freed aren't reported too
+    if success and orphan_scan != "":
+        orphans_success, orphan_map = scanOrphans(ec2_client_map, max_workers, orphan_min_age_days, orphan_description)
+        print("Orphan map:\n{}".format(json.dumps(orphan_map, indent=4)))
+        if orphan_scan == "reap":
+            orphans_success = deleteOrphans(ec2_client_map, orphan_map, pending) and orphans_success
+        success = orphans_success
+    if pending is not None and not verifyDeletions(ec2_client_map, pending, verify_timeout):
+        success = False
+
+    metrics.report(metrics_filename, "reapamibyname")
+    stopLog()
+    exit(not success)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+INDEX_VERSION = 1
+
+
+@dataclass
+class SubBuild:
+    """What promotegcptoprod needs from one GCP sub-build directory.
+
+    Fields are empty when the matching file was missing; callers decide what
+    to fall back to.
+    """
+
+    name: str
+    image_name: str = ""
+    project_id: str = ""
+    destination_project_id: str = ""
+    object_storage: str = ""
+
+
+@dataclass
+class SnapshotIndex:
+    """Everything the actions read out of one SNAPSHOT-<date> directory."""
+
+    path: str
+    date: str
+    ami_file: str = ""
+    ami_map: Dict[str, str] = field(default_factory=dict)
+    s3_files: Optional[List[str]] = None
+    resources: Optional[dict] = None
+    sub_builds: List[SubBuild] = field(default_factory=list)
+    # relative path -> [mtime_ns, size] for every file and directory read
+    sources: Dict[str, List[int]] = field(default_factory=dict)
+
+
+def indexFilename(snapshot_path):
+    # Kept beside the snapshot rather than inside it, so writing the index
+    # doesn't change the snapshot directory's own mtime
+    snapshot_path = os.path.normpath(snapshot_path)
+    return os.path.join(os.path.dirname(snapshot_path), ".{}.amimgmt-index.json".format(os.path.basename(snapshot_path)))
+
+
+def statSource(snapshot_path, relpath):
+    stat = os.stat(os.path.join(snapshot_path, relpath))
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def readText(snapshot_path, relpath, index):
+    try:
+        with open(os.path.join(snapshot_path, relpath), "r") as a_file:
+            text = a_file.read()
+        index.sources.update({relpath: statSource(snapshot_path, relpath)})
+        return text
+    except OSError:
+        return None
+
+
+def readJSON(snapshot_path, relpath, index):
+    text = readText(snapshot_path, relpath, index)
+    if text is None:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def scanSubBuild(snapshot_path, snapshot_date, dirname, index):
+    sub_build = SubBuild(dirname)
+    index.sources.update({dirname: statSource(snapshot_path, dirname)})
+    for manifest in ["gcp-machine-image-manifest.json", "gcp-machine-image-manifest_{}.json".format(snapshot_date)]:
+        resource_map = readJSON(snapshot_path, os.path.join(dirname, manifest), index)
+        try:
+            sub_build.image_name = resource_map["builds"][0]["artifact_id"]
+            break
+        except (KeyError, IndexError, TypeError):
+            pass
+    for attribute, filename in [
+        ("project_id", "gcp_project_id.txt"),
+        ("destination_project_id", "destination_project_id.txt"),
+        ("object_storage", "object-storage.out"),
+    ]:
+        text = readText(snapshot_path, os.path.join(dirname, filename), index)
+        if text is not None:
+            setattr(sub_build, attribute, text.strip())
+    return sub_build
+
+
+def scanSnapshot(snapshot_path, snapshot_date):
+    index = SnapshotIndex(snapshot_path, snapshot_date)
+    try:
+        index.sources.update({".": statSource(snapshot_path, ".")})
+        entries = sorted(os.listdir(snapshot_path))
+    except OSError:
+        return index
+    ami_files = ["aws-ami-regions_SNAPSHOT-{}.json".format(snapshot_date)]
+    ami_files.extend(entry for entry in entries if entry.startswith("aws-ami") and entry.endswith(".json"))
+    for ami_file in ami_files:
+        ami_map = readJSON(snapshot_path, ami_file, index)
+        if isinstance(ami_map, dict):
+            index.ami_file = ami_file
+            index.ami_map = ami_map
+            break
+    s3_text = readText(snapshot_path, "s3_file_locations.txt", index)
+    if s3_text is not None:
+        index.s3_files = [line.strip() for line in s3_text.splitlines() if line.strip() != ""]
+    index.resources = readJSON(snapshot_path, "resources-{}.json".format(snapshot_date), index)
+    for entry in entries:
+        if os.path.isdir(os.path.join(snapshot_path, entry)):
+            index.sub_builds.append(scanSubBuild(snapshot_path, snapshot_date, entry, index))
+    return index
+
+
+def loadIndexFile(snapshot_path, snapshot_date):
+    try:
+        with open(indexFilename(snapshot_path), "r") as index_file:
+            saved = json.load(index_file)
+        if saved.get("version") != INDEX_VERSION or saved["index"]["date"] != snapshot_date:
+            return None
+        index = SnapshotIndex(**saved["index"])
+        index.path = snapshot_path
+        index.sub_builds = [SubBuild(**sub_build) for sub_build in index.sub_builds]
+        # Any file or directory that changed (directories cover files being
+        # added or removed) means the index is stale
+        for relpath in index.sources:
+            if statSource(snapshot_path, relpath) != index.sources[relpath]:
+                return None
+        return index
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def saveIndexFile(index):
+    filename = indexFilename(index.path)
+    try:
+        with open(filename + ".tmp", "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "index": asdict(index)}, index_file, separators=(",", ":"))
+        os.replace(filename + ".tmp", filename)
+    except OSError:
+        # A read-only checkout just means the next action rebuilds the index
+        pass
+
+
+def loadSnapshotIndex(snapshot_path, snapshot_date):
+    index = loadIndexFile(snapshot_path, snapshot_date)
+    if index is None:
+        index = scanSnapshot(snapshot_path, snapshot_date)
+        if "." in index.sources:
+            saveIndexFile(index)
+    return index
+
+
+def findAMIs(index):
+    if index.ami_file != "aws-ami-regions_SNAPSHOT-{}.json".format(index.date):
+        print("Didn't find {}/aws-ami-regions_SNAPSHOT-{}.json; checking by name".format(index.path, index.date))
+        if index.ami_file != "":
+            print("...and succeeded with {}".format(index.ami_file))
+        else:
+            print("Didn't find regions in any {}/aws-ami*.json file.".format(index.path))
+    return index.ami_map
+
+
+def saveAMIMap(index, ami_map):
+    # Written in place of the file it was read from, so later steps (and the
+    # reaper) see every region the AMI now lives in
+    filename = os.path.join(index.path, index.ami_file or "aws-ami-regions_SNAPSHOT-{}.json".format(index.date))
+    with open(filename + ".tmp", "w") as ami_file:
+        json.dump(ami_map, ami_file, indent=4, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+    index.ami_map = ami_map
+    return filename
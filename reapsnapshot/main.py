@@ -1,247 +1,760 @@
 import os
-import boto3
 import botocore.exceptions
+import datetime
 import json
-import glob
+import re
 from io import StringIO
-import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from amimgmt.clients import loginEC2Clients, loginS3Client, newClientPool, newSession, whoami
+from amimgmt.ec2 import PROMOTION_TAG, describeImages, describeSnapshots, findTagged, imageSnapshots
+from amimgmt.inputs import env_set, envFlag
+from amimgmt.inventory import Inventory
+from amimgmt.journal import Journal
+from amimgmt.log import logEvent, startLog, stopLog
+from amimgmt.metrics import Metrics
+from amimgmt.s3 import bucketRegion, splitS3URI
+from amimgmt.snapshot import findAMIs, loadSnapshotIndex
+from amimgmt.verify import PendingDeletions, verifyDeletions
 
+# Bumped whenever the plan file's layout changes
+PLAN_VERSION = 3
+# Written into a swept snapshot directory once everything in it is reaped
+REAPED_MARKER = "reaped.json"
+# Snapshot dates, and the date every artifact name ends with, e.g.
+# functions/controller-2021-08-01-19-23-28.zip
+SNAPSHOT_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$")
+ARTIFACT_DATE = re.compile(r"-(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})\.[^/]+$")
 
-def env_set(env_var, default):
-    if env_var in os.environ:
-        return os.environ[env_var]
-    elif os.path.exists(env_var) and os.path.getsize(env_var) > 0:
-        with open(env_var, "r") as env_file:
-            var = env_file.read().strip()
-            env_file.close()
-        return var
-    else:
-        return default
 
+def findExpiredSnapshots(snapshots_root, retention_keep, retention_older_than):
+    # SNAPSHOT-<date> names sort chronologically, so the newest snapshots are
+    # simply the last ones.  When both rules are given a snapshot has to fail
+    # both of them to be reaped.
+    snapshot_dates = []
+    for dirname in sorted(next(os.walk(snapshots_root))[1]):
+        if not dirname.startswith("SNAPSHOT-"):
+            continue
+        if SNAPSHOT_DATE.match(dirname[len("SNAPSHOT-") :]) is None:
+            print("{} isn't named SNAPSHOT-<yyyy-mm-dd-hh-mm-ss>, ignoring it".format(dirname))
+            continue
+        snapshot_dates.append(dirname[len("SNAPSHOT-") :])
+    expired = list(snapshot_dates)
+    if retention_keep != "":
+        keep = int(retention_keep)
+        expired = expired[: max(0, len(snapshot_dates) - keep)]
+    if retention_older_than != "":
+        expired = [snapshot_date for snapshot_date in expired if snapshot_date < retention_older_than]
+    # Reaped snapshots still count towards retention_keep, but there's
+    # nothing left in AWS to look them up again for
+    reaped = [snapshot_date for snapshot_date in expired if os.path.exists(os.path.join(snapshots_root, "SNAPSHOT-" + snapshot_date, REAPED_MARKER))]
+    expired = [snapshot_date for snapshot_date in expired if snapshot_date not in reaped]
+    print(
+        "Found {} snapshots in {}, {} expired, {} of those already reaped".format(len(snapshot_dates), snapshots_root, len(expired) + len(reaped), len(reaped))
+    )
+    return [("{}/SNAPSHOT-{}".format(snapshots_root, snapshot_date), snapshot_date) for snapshot_date in expired]
 
-def whoami():
-    client = boto3.client("sts")
-    response = client.get_caller_identity()["Account"]
-    return response
 
+def reapableDates(snapshot_map, protected):
+    # A snapshot that kept a deployed AMI keeps its S3 artifacts too, and
+    # isn't finished with
+    return [date for date in snapshot_map if len(protected & set(snapshot_map[date]["ami_map"].values())) == 0]
 
-def findAMIs(snapshot_path, snapshot_date):
-    ami_map = {}
-    try:
-        with open("{}/aws-ami-regions_SNAPSHOT-{}.json".format(snapshot_path, snapshot_date), "r") as ami_file:
-            ami_text = ami_file.read()
-            ami_map = json.loads(ami_text)
-    except:
-        print("Didn't find {}/aws-ami-regions_SNAPSHOT-{}.json; checking by name".format(snapshot_path, snapshot_date))
-        filenamesList = glob.glob("{}/aws-ami*.json".format(snapshot_path))
-        try:
-            with open("{}".format(filenamesList[0]), "r") as ami_file:
-                ami_text = ami_file.read()
-                ami_map = json.loads(ami_text)
-            print("...and succeeded")
-        except:
-            print("Didn't find regions when looking at the first file name in {}.".format(json.dumps(filenamesList)))
-    return ami_map
-
-
-def loginEC2Clients(ami_map):
-    client_map = {}
-    for region in ami_map:
-        os.environ["AWS_DEFAULT_REGION"] = region
-        client = boto3.client("ec2")
-        element = {region: client}
-        client_map.update(element)
-    return client_map
-
-
-def loginS3Client(region):
-    os.environ["AWS_DEFAULT_REGION"] = region
-    client = boto3.client("s3")
-    return client
-
-
-def findSNAPs(client_map, ami_map):
-    snap_map = {}
-    for region in ami_map:
-        client = client_map[region]
+
+def reapableS3Files(snapshot_map, protected):
+    return [s3_file for date in reapableDates(snapshot_map, protected) for s3_file in snapshot_map[date]["s3_files"]]
+
+
+def markReaped(snapshots_root, snapshot_dates, aws_account_id):
+    for snapshot_date in snapshot_dates:
+        marker = os.path.join(snapshots_root, "SNAPSHOT-" + snapshot_date, REAPED_MARKER)
         try:
-            response = client.describe_images(ImageIds=[ami_map[region]])
-            for image in response["Images"]:
-                for blockDeviceMap in image["BlockDeviceMappings"]:
-                    snap = blockDeviceMap["Ebs"]["SnapshotId"]
-                    element = {region: snap}
-                    snap_map.update(element)
-        except:
-            print("Nope, AMI {} isn't in this region, so we can't look up its snaps".format(ami_map[region]))
-    return snap_map
-
-
-def findS3Filenames(ec2_client_map, snapshot_path, snapshot_date):
+            with open(marker, "w") as out_file:
+                json.dump({"account_id": aws_account_id, "reaped": datetime.datetime.now(datetime.timezone.utc).isoformat()}, out_file, indent=4)
+            print("Marked SNAPSHOT-{} reaped".format(snapshot_date))
+        except OSError as err1:
+            print("Couldn't write {}: {}".format(marker, err1))
+
+
+def journaledSNAPs(record):
+    # Journals from before multi-volume AMIs were handled hold a single ID
+    snaps = record.get("snapshot")
+    if snaps is None:
+        return []
+    return [snaps] if isinstance(snaps, str) else snaps
+
+
+def guessS3Filenames(bucket, snapshot_date):
+    return [
+        "s3://{}/functions/controller-{}.zip".format(bucket, snapshot_date),
+        "s3://{}/functions/efs-{}.zip".format(bucket, snapshot_date),
+        "s3://{}/functions/rds-{}.zip".format(bucket, snapshot_date),
+        "s3://{}/cdk/template-production-{}.json".format(bucket, snapshot_date),
+        "s3://{}/cdk/template-development-{}.json".format(bucket, snapshot_date),
+    ]
+
+
+def listS3Filenames(s3_client, bucket):
+    # One paginated listing per prefix finds every snapshot's artifacts, not
+    # just the names we know to guess, grouped by the date ending each name
+    date_files = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for prefix in ["functions/", "cdk/"]:
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for s3_object in page.get("Contents", []):
+                match = ARTIFACT_DATE.search(s3_object["Key"].rpartition("/")[2])
+                if match is not None:
+                    date_files.setdefault(match.group(1), []).append("s3://{}/{}".format(bucket, s3_object["Key"]))
+    return date_files
+
+
+def findS3Filenames(client_pool, ec2_client_map, index, listings):
+    # listings caches each bucket's listing (or the error listing it hit)
+    # so a sweep lists every bucket once, however many snapshots it reaps
+    snapshot_date = index.date
     s3_filename_list = []
-    try:
-        with open("{}/s3_file_locations.txt".format(snapshot_path), "r") as lambda_file:
-            lambda_text = lambda_file.readlines()
-            for line in lambda_text:
-                s3_filename_list.append(line.strip())
-    except:
-        print("Didn't find {}/s3_file_locations.txt; assuming positronic-asimov for S3 bucket.".format(snapshot_path))
+    if index.s3_files is not None:
+        s3_filename_list.extend(index.s3_files)
+    elif SNAPSHOT_DATE.match(snapshot_date) is None:
+        print("Didn't find {}/s3_file_locations.txt, and {} isn't a snapshot date to list S3 for".format(index.path, json.dumps(snapshot_date)))
+    else:
+        print("Didn't find {}/s3_file_locations.txt; listing positronic-asimov for S3 bucket.".format(index.path))
         for region in ec2_client_map:
-            s3_filename_list.append("s3://positronic-asimov-{}/functions/controller-{}.zip".format(region, snapshot_date))
-            s3_filename_list.append("s3://positronic-asimov-{}/functions/efs-{}.zip".format(region, snapshot_date))
-            s3_filename_list.append("s3://positronic-asimov-{}/functions/rds-{}.zip".format(region, snapshot_date))
-            s3_filename_list.append("s3://positronic-asimov-{}/cdk/template-production-{}.json".format(region, snapshot_date))
-            s3_filename_list.append("s3://positronic-asimov-{}/cdk/template-development-{}.json".format(region, snapshot_date))
+            bucket = "positronic-asimov-{}".format(region)
+            if bucket not in listings:
+                try:
+                    listings.update({bucket: listS3Filenames(loginS3Client(client_pool, region), bucket)})
+                except botocore.exceptions.ClientError as err1:
+                    listings.update({bucket: err1})
+            if not isinstance(listings[bucket], botocore.exceptions.ClientError):
+                found = listings[bucket].get(snapshot_date, [])
+                print("Found {} keys for {} in S3 bucket: {}".format(len(found), snapshot_date, bucket))
+                s3_filename_list.extend(found)
+            elif listings[bucket].response["Error"]["Code"] == "NoSuchBucket":
+                print("No S3 bucket {}, ok".format(bucket))
+            else:
+                # Can't see what's there, so fall back to the names we'd expect
+                print("Try of list_objects_v2 {} error: {}; guessing keys".format(bucket, listings[bucket]))
+                s3_filename_list.extend(guessS3Filenames(bucket, snapshot_date))
     return s3_filename_list
 
 
-def deleteAMIs(client_map, ami_map, dry_run):
-    print("deleteAMIs entry, dry_run is {}".format(dry_run))
+def deleteAMI(client, region, ami_id, image, snaps, dry_run, out, pending=None, journal=None):
+    # The journal keeps the snapshot IDs, which can't be looked up once the AMI is gone
+    success = True
+    print("Looking for {} in region {}:".format(ami_id, region), file=out)
+    if image is None:
+        print("AMI no longer present; continuing.", file=out)
+        logEvent(ami_id, region, "deregister_image", "gone")
+        if journal is not None:
+            journal.record(ami_id, region, "deregister_image", "gone", snapshot=snaps)
+        return success
+    started = time.monotonic()
+    try:
+        response = client.deregister_image(ImageId=ami_id, DryRun=dry_run)
+        if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
+            print("Deleted, ok", file=out)
+            logEvent(ami_id, region, "deregister_image", "deleted", started)
+            if pending is not None:
+                pending.image(region, ami_id)
+            if journal is not None:
+                journal.record(ami_id, region, "deregister_image", "deleted", snapshot=snaps)
+        else:
+            print(json.dumps(response, indent=4), file=out)
+            logEvent(ami_id, region, "deregister_image", "unknown", started)
+    except botocore.exceptions.ClientError as err2:
+        if err2.response["Error"]["Code"] == "DryRunOperation":
+            print("Dry run, ok", file=out)
+            logEvent(ami_id, region, "deregister_image", "dry-run", started)
+        elif err2.response["Error"]["Code"] in ["InvalidAMIID.Unavailable", "InvalidAMIID.NotFound"]:
+            print("Already gone, ok", file=out)
+            logEvent(ami_id, region, "deregister_image", "gone", started)
+            if journal is not None:
+                journal.record(ami_id, region, "deregister_image", "gone", snapshot=snaps)
+        else:
+            print("Try of deregister_image error: {}".format(err2), file=out)
+            logEvent(ami_id, region, "deregister_image", "failed", started, error=err2.response["Error"]["Code"])
+            success = False
+    return success
+
+
+def deleteSNAP(client, region, snap_id, dry_run, out, pending=None, ami_id=None, journal=None):
     success = True
-    for region in ami_map:
+    started = time.monotonic()
+    try:
+        print("Looking for {} in region {}:".format(snap_id, region), file=out)
+        response = client.delete_snapshot(SnapshotId=snap_id, DryRun=dry_run)
+        if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
+            print("Deleted, ok", file=out)
+            logEvent(snap_id, region, "delete_snapshot", "deleted", started)
+            if pending is not None:
+                pending.snapshot(region, snap_id)
+            if journal is not None:
+                journal.record(snap_id, region, "delete_snapshot", "deleted", image=ami_id)
+        else:
+            print(json.dumps(response, indent=4), file=out)
+            logEvent(snap_id, region, "delete_snapshot", "unknown", started)
+    except botocore.exceptions.ClientError as err2:
+        if err2.response["Error"]["Code"] == "DryRunOperation":
+            print("Dry run, ok", file=out)
+            logEvent(snap_id, region, "delete_snapshot", "dry-run", started)
+        elif err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
+            print("Already gone, ok", file=out)
+            logEvent(snap_id, region, "delete_snapshot", "gone", started)
+            if journal is not None:
+                journal.record(snap_id, region, "delete_snapshot", "gone", image=ami_id)
+        elif err2.response["Error"]["Code"] == "InvalidSnapshot.InUse" and pending is not None:
+            # The deregistration hasn't let go of it yet; verifyDeletions
+            # deletes it again once the AMI is confirmed gone
+            print("In use, retrying once {} is gone".format(ami_id), file=out)
+            logEvent(snap_id, region, "delete_snapshot", "in-use", started)
+            pending.inUse(region, snap_id, ami_id)
+        else:
+            print("Try of delete_snapshot error: {}\n{}".format(json.dumps(err2.response, indent=4), err2), file=out)
+            logEvent(snap_id, region, "delete_snapshot", "failed", started, error=err2.response["Error"]["Code"])
+            success = False
+    return success
+
+
+def reapRegion(client, region, ami_ids, dry_run, inventory, pending=None, journal=None, images=None, planned=None):
+    # Run one region's find -> deregister -> delete-snapshot chain, buffering
+    # its transcript so concurrent regions don't interleave in the log
+    out = StringIO()
+    snaps = {}
+    print("Region {}:".format(region), file=out)
+    # AMIs an earlier run already deregistered need no describe; the journal
+    # remembers their snapshots
+    resumed = {}
+    if journal is not None:
+        for ami_id in ami_ids:
+            record = journal.finished(ami_id, "deregister_image")
+            if record is not None:
+                resumed.update({ami_id: record})
+    remaining = [ami_id for ami_id in ami_ids if ami_id not in resumed]
+    image_records = {}
+    started = time.monotonic()
+    try:
+        if images is not None:
+            # Already described, and checked against a plan, by the caller
+            image_records = images
+        elif len(remaining) == 0:
+            pass
+        elif inventory is not None:
+            image_records = inventory.findImages(client, region, remaining)
+        else:
+            image_records = describeImages(client, remaining)
+    except botocore.exceptions.ClientError as err1:
+        print("Try of describe_images error: {}\n{}".format(json.dumps(err1.response, indent=4), err1), file=out)
+        logEvent(",".join(remaining), region, "describe_images", "failed", started, error=err1.response["Error"]["Code"])
+        return False, snaps, out.getvalue()
+    success = True
+    for ami_id in ami_ids:
+        if ami_id in resumed:
+            print("{} in region {} deregistered by an earlier run, skipping".format(ami_id, region), file=out)
+            ami_snaps = journaledSNAPs(resumed[ami_id])
+        else:
+            image = image_records.get(ami_id)
+            ami_snaps = []
+            if image is not None:
+                ami_snaps = imageSnapshots(image)
+            elif planned is not None:
+                ami_snaps = planned.get(ami_id, [])
+            if not deleteAMI(client, region, ami_id, image, ami_snaps, dry_run, out, pending, journal):
+                success = False
+                continue
+        if len(ami_snaps) > 0:
+            snaps.update({ami_id: ami_snaps})
+        for snap in ami_snaps:
+            if journal is not None and journal.finished(snap, "delete_snapshot") is not None:
+                print("{} in region {} deleted by an earlier run, skipping".format(snap, region), file=out)
+            elif not deleteSNAP(client, region, snap, dry_run, out, pending, ami_id, journal):
+                success = False
+    return success, snaps, out.getvalue()
+
+
+def reapRegions(client_map, region_amis, dry_run, max_workers, inventory=None, pending=None, journal=None, images=None, planned=None):
+    print("reapRegions entry, dry_run is {}, max_workers is {}".format(dry_run, max_workers))
+    success = True
+    snaps = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                reapRegion,
+                client_map[region],
+                region,
+                region_amis[region],
+                dry_run,
+                inventory,
+                pending,
+                journal,
+                None if images is None else images.get(region, {}),
+                planned,
+            )
+            for region in region_amis
+        ]
+        # Collect in submission order so the log reads the same from run to run
+        for future in futures:
+            region_success, region_snaps, transcript = future.result()
+            print(transcript, end="")
+            snaps.update(region_snaps)
+            if not region_success:
+                success = False
+    print("reapRegions exit, returning {}".format(success))
+    return success, snaps
+
+
+def findS3Versions(s3_client, bucket, keys):
+    # One listing per directory, under the common prefix of its keys, rather
+    # than one per key
+    wanted = set(keys)
+    directories = {}
+    for key in keys:
+        directories.setdefault(key.rpartition("/")[0], []).append(key)
+    objects = []
+    paginator = s3_client.get_paginator("list_object_versions")
+    for directory in sorted(directories):
+        for page in paginator.paginate(Bucket=bucket, Prefix=os.path.commonprefix(directories[directory])):
+            for version in page.get("Versions", []) + page.get("DeleteMarkers", []):
+                if version["Key"] in wanted:
+                    objects.append({"Key": version["Key"], "VersionId": version["VersionId"]})
+    return objects
+
+
+def probeS3Keys(s3_client, bucket, keys, purge_versions):
+    success = True
+    region = s3_client.meta.region_name
+    for key in keys:
+        started = time.monotonic()
         try:
-            print("Looking for {} in region {}:".format(ami_map[region], region))
-            client_map[region].describe_images(ImageIds=[ami_map[region]])
-            try:
-                response = client_map[region].deregister_image(ImageId=ami_map[region], DryRun=dry_run)
-                if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                    print("Deleted, ok")
-                else:
-                    print(json.dumps(response, indent=4))
-            except botocore.exceptions.ClientError as err2:
-                if err2.response["Error"]["Code"] == "DryRunOperation":
-                    print("Dry run, ok")
-                elif err2.response["Error"]["Code"] == "InvalidAMIID.Unavailable":
-                    print("Already gone, ok")
-                else:
-                    print("Try of deregister_image error: {}".format(err2))
-                    success = False
+            response = s3_client.head_object(Bucket=bucket, Key=key)
+            print("Would delete {} ({} bytes), ok".format(key, response["ContentLength"]))
+            logEvent("s3://{}/{}".format(bucket, key), region, "delete_object", "dry-run", started, bytes=response["ContentLength"])
         except botocore.exceptions.ClientError as err1:
-            if err1.response["Error"]["Code"] == "InvalidAMIID.NotFound":
-                print("AMI no longer present; continuing.")
+            if err1.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+                print("Missing {}, ok".format(key))
+                logEvent("s3://{}/{}".format(bucket, key), region, "delete_object", "gone", started)
+            elif err1.response["Error"]["Code"] == "NoSuchBucket":
+                raise
             else:
-                print("Try of describe_images error: {}\n{}".format(json.dumps(err1.response, indent=4), err1))
                 success = False
-    print("deleteAMIs exit, returning {}".format(success))
+                logEvent("s3://{}/{}".format(bucket, key), region, "delete_object", "failed", started, error=err1.response["Error"]["Code"])
+                print("Try of head_object {}/{} error: {}\n{}".format(bucket, key, json.dumps(err1.response, indent=4, sort_keys=True, default=str), err1))
+    if purge_versions:
+        print("Would purge {} versions and delete markers".format(len(findS3Versions(s3_client, bucket, keys))))
     return success
 
 
-def deleteSNAPs(client_map, snap_map, dry_run):
-    print("deleteSNAPs entry, dry_run is {}".format(dry_run))
+def deleteS3Keys(s3_client, bucket, keys, purge_versions, journal=None):
     success = True
-    for region in snap_map:
-        try:
-            print("Looking for {} in region {}:".format(snap_map[region], region))
-            response = client_map[region].delete_snapshot(SnapshotId=snap_map[region], DryRun=dry_run)
-            if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                print("Deleted, ok")
-            else:
-                print(json.dumps(response, indent=4))
-        except botocore.exceptions.ClientError as err2:
-            if err2.response["Error"]["Code"] == "DryRunOperation":
-                print("Dry run, ok")
-            elif err2.response["Error"]["Code"] == "InvalidSnapshot.NotFound":
-                print("Already gone, ok")
+    if purge_versions:
+        objects = findS3Versions(s3_client, bucket, keys)
+    else:
+        objects = [{"Key": key} for key in keys]
+    # A key is finished with the batch holding its last version
+    last_batch = {key: 0 for key in keys}
+    for position, s3_object in enumerate(objects):
+        last_batch.update({s3_object["Key"]: position - position % 1000})
+    failed = set()
+    # delete_objects takes up to 1000 keys per request and reports failures
+    # per key in the response body rather than raising
+    region = s3_client.meta.region_name
+    for start in range(0, len(objects), 1000):
+        started = time.monotonic()
+        response = s3_client.delete_objects(Bucket=bucket, Delete={"Objects": objects[start : start + 1000], "Quiet": False})
+        # Every key in a batch shares the batch's duration
+        for deleted in response.get("Deleted", []):
+            print("Deleted {}{}, ok".format(deleted["Key"], " version {}".format(deleted["VersionId"]) if "VersionId" in deleted else ""))
+            logEvent("s3://{}/{}".format(bucket, deleted["Key"]), region, "delete_object", "deleted", started, version=deleted.get("VersionId"))
+        for error in response.get("Errors", []):
+            if error["Code"] == "NoSuchKey":
+                print("Missing {}, ok".format(error["Key"]))
+                logEvent("s3://{}/{}".format(bucket, error["Key"]), region, "delete_object", "gone", started)
             else:
-                print("Try of delete_snapshot error: {}\n{}".format(json.dumps(err2.response, indent=4), err2))
                 success = False
-    print("deleteSNAPs exit, returning {}".format(success))
+                failed.add(error["Key"])
+                print("Try of delete_objects {}/{} error: {} {}".format(bucket, error["Key"], error["Code"], error.get("Message", "")))
+                logEvent("s3://{}/{}".format(bucket, error["Key"]), region, "delete_object", "failed", started, error=error["Code"])
+        if journal is not None:
+            for key in keys:
+                if last_batch[key] == start and key not in failed:
+                    journal.record("s3://{}/{}".format(bucket, key), region, "delete_object", "deleted")
+    if journal is not None and len(objects) == 0:
+        for key in keys:
+            journal.record("s3://{}/{}".format(bucket, key), region, "delete_object", "gone")
     return success
 
 
-def deleteS3Files(s3_filename_list, dry_run):
-    print("deleteS3Files entry, dry_run is {}".format(dry_run))
+def deleteS3Files(client_pool, s3_filename_list, dry_run, purge_versions, journal=None):
+    print("deleteS3Files entry, dry_run is {}, purge_versions is {}".format(dry_run, purge_versions))
     success = True
-    region = ""
+    bucket_keys = {}
     for s3_file in s3_filename_list:
-        # Break up an S3 URI into usable bits i.e.
-        # s3://positronic-asimov-us-west-2/cdk/template-development-2022-07-12-10-44-52.json
-        # --> positronic-asimov-us-west-2 --> cdk/template-development-2022-07-12-10-44-52.json
-        parts = s3_file.split("s3://")
-        bucket = parts[1].split("/")[0]
-        bucket_array = bucket.split("-")
-        num_bucket_bits = len(bucket_array)
-        new_region = "{}-{}-{}".format(bucket_array[num_bucket_bits - 3],bucket_array[num_bucket_bits - 2],bucket_array[num_bucket_bits - 1])
-        if new_region != region:
-            region = new_region
-            print("New S3 region: {}".format(new_region))
-            s3_client = loginS3Client(new_region)
-        start = len(bucket) + s3_file.find(bucket) + 1
-        key = s3_file[start:]
-        print("Looking for S3 bucket: {} key: {} in region: {}".format(bucket, key, region))
+        if journal is not None and journal.finished(s3_file, "delete_object") is not None:
+            print("{} deleted by an earlier run, skipping".format(s3_file))
+            continue
+        bucket, key = splitS3URI(s3_file)
+        bucket_keys.setdefault(bucket, []).append(key)
+    for bucket in bucket_keys:
+        region = bucketRegion(bucket)
+        s3_client = loginS3Client(client_pool, region)
+        print("Looking for {} keys in S3 bucket: {} in region: {}".format(len(bucket_keys[bucket]), bucket, region))
         try:
             if dry_run:
-                response = s3_client.list_objects(Bucket=bucket)
-                if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-                    print("Listed, ok")
-                else:
-                    print(json.dumps(response, indent=4, sort_keys=True, default=str))
+                bucket_success = probeS3Keys(s3_client, bucket, bucket_keys[bucket], purge_versions)
             else:
-                response = s3_client.delete_object(Bucket=bucket, Key=key)
-                if response["ResponseMetadata"]["HTTPStatusCode"] == 204:
-                    print("Deleted, ok")
-                else:
-                    print(json.dumps(response, indent=4, sort_keys=True, default=str))
+                bucket_success = deleteS3Keys(s3_client, bucket, bucket_keys[bucket], purge_versions, journal)
+            if not bucket_success:
+                success = False
         except botocore.exceptions.ClientError as err1:
-            if err1.response["Error"]["Code"] == "404":
-                print("Missing, ok")
-            elif err1.response["Error"]["Code"] == "NoSuchBucket":
+            if err1.response["Error"]["Code"] == "NoSuchBucket":
                 print("Entire bucket missing, ok")
+                logEvent("s3://{}".format(bucket), region, "delete_objects", "gone")
+                if journal is not None:
+                    for key in bucket_keys[bucket]:
+                        journal.record("s3://{}/{}".format(bucket, key), region, "delete_object", "gone")
             else:
                 success = False
-                print("Try of delete_object {}/{} error: {}\n{}".format(bucket, key, json.dumps(err1.response, indent=4, sort_keys=True, default=str), err1))
+                print("Try of S3 bucket {} error: {}\n{}".format(bucket, json.dumps(err1.response, indent=4, sort_keys=True, default=str), err1))
     print("deleteS3Files exit, returning {}".format(success))
     return success
 
 
+def dropDeployed(client_map, region_amis, max_workers):
+    # A sweep goes by age alone and promoted snapshots tend to be the oldest,
+    # so every AMI promotesnapshot tagged deployed is kept, snapshots and all
+    success = True
+    kept = {}
+    protected = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {region: executor.submit(findTagged, client_map[region], region_amis[region], "deployed") for region in region_amis}
+        for region in futures:
+            try:
+                deployed = futures[region].result()
+            except botocore.exceptions.ClientError as err1:
+                print("Try of describe_tags in region {} error: {}; not reaping anything there".format(region, err1))
+                logEvent(",".join(region_amis[region]), region, "describe_tags", "failed", error=err1.response["Error"]["Code"])
+                protected.update(region_amis[region])
+                success = False
+                continue
+            for ami_id in region_amis[region]:
+                if ami_id in deployed:
+                    print("{} in region {} is tagged {}=deployed, keeping it and its snapshots".format(ami_id, region, PROMOTION_TAG))
+                    logEvent(ami_id, region, "deregister_image", "protected", tag=PROMOTION_TAG)
+            kept.update({region: [ami_id for ami_id in region_amis[region] if ami_id not in deployed]})
+            protected.update(deployed)
+    return success, kept, protected
+
+
+def describeRegion(client, region, ami_ids, inventory=None):
+    if inventory is not None:
+        return inventory.findImages(client, region, ami_ids)
+    return describeImages(client, ami_ids)
+
+
+def describeRegions(client_map, region_amis, max_workers, inventory=None):
+    # One batched describe per region, with the regions in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {region: executor.submit(describeRegion, client_map[region], region, region_amis[region], inventory) for region in region_amis}
+        return {region: futures[region].result() for region in futures}
+
+
+def statS3Files(client_pool, s3_filename_list):
+    # One listing per bucket directory instead of a HEAD per key
+    directories = {}
+    for s3_file in s3_filename_list:
+        bucket, key = splitS3URI(s3_file)
+        directories.setdefault((bucket, key.rpartition("/")[0]), []).append(key)
+    found = {}
+    for bucket, directory in sorted(directories):
+        keys = directories[(bucket, directory)]
+        s3_client = loginS3Client(client_pool, bucketRegion(bucket))
+        paginator = s3_client.get_paginator("list_objects_v2")
+        try:
+            for page in paginator.paginate(Bucket=bucket, Prefix=os.path.commonprefix(keys)):
+                for s3_object in page.get("Contents", []):
+                    if s3_object["Key"] in keys:
+                        found.update({"s3://{}/{}".format(bucket, s3_object["Key"]): {"etag": s3_object["ETag"], "size": s3_object["Size"]}})
+        except botocore.exceptions.ClientError as err1:
+            if err1.response["Error"]["Code"] != "NoSuchBucket":
+                raise
+    return found
+
+
+def makePlan(client_map, client_pool, region_amis, s3_filename_list, max_workers, inventory=None, journal=None):
+    # Everything the reap would touch, as it stands right now
+    images = describeRegions(client_map, region_amis, max_workers, inventory)
+    plan_images = []
+    plan_snapshots = []
+    for region in region_amis:
+        snap_amis = {}
+        for ami_id in region_amis[region]:
+            image = images[region].get(ami_id)
+            record = None if journal is None else journal.finished(ami_id, "deregister_image")
+            if image is not None:
+                snaps = imageSnapshots(image)
+            elif record is not None:
+                snaps = journaledSNAPs(record)
+            else:
+                print("{} in region {} is already gone; leaving it out of the plan".format(ami_id, region))
+                continue
+            plan_images.append({"region": region, "ami_id": ami_id, "state": "gone" if image is None else image["State"], "snapshot": snaps})
+            for snap in snaps:
+                snap_amis.update({snap: ami_id})
+        snapshots = describeSnapshots(client_map[region], sorted(snap_amis))
+        for snap in sorted(snapshots):
+            plan_snapshots.append({"region": region, "snapshot_id": snap, "state": snapshots[snap]["State"], "image": snap_amis[snap]})
+    found = statS3Files(client_pool, s3_filename_list)
+    plan_s3_objects = []
+    for s3_file in s3_filename_list:
+        if s3_file in found:
+            entry = {"uri": s3_file, "region": bucketRegion(splitS3URI(s3_file)[0])}
+            entry.update(found[s3_file])
+            plan_s3_objects.append(entry)
+    print("Plan: {} AMIs, {} snapshots, {} S3 objects".format(len(plan_images), len(plan_snapshots), len(plan_s3_objects)))
+    return {"images": plan_images, "snapshots": plan_snapshots, "s3_objects": plan_s3_objects}
+
+
+def savePlan(plan_filename, plan):
+    with open(plan_filename + ".tmp", "w") as out_file:
+        json.dump(plan, out_file, indent=4, default=str)
+    os.replace(plan_filename + ".tmp", plan_filename)
+    print("Wrote plan to {}".format(plan_filename))
+
+
+def loadPlan(plan_filename, aws_account_id):
+    try:
+        with open(plan_filename, "r") as in_file:
+            plan = json.load(in_file)
+    except (OSError, ValueError) as err1:
+        print("Couldn't read plan {}: {}".format(plan_filename, err1))
+        return None
+    if plan.get("version") != PLAN_VERSION:
+        print("Plan {} is version {}, expected {}; make a new plan".format(plan_filename, plan.get("version"), PLAN_VERSION))
+        return None
+    if plan["account_id"] != aws_account_id:
+        print("Plan {} was made for account {}, not {}".format(plan_filename, plan["account_id"], aws_account_id))
+        return None
+    print("Applying plan {} made {}".format(plan_filename, plan["created"]))
+    return plan
+
+
+def describeSnapshotRegions(client_map, region_snaps, max_workers):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {region: executor.submit(describeSnapshots, client_map[region], region_snaps[region]) for region in region_snaps}
+        return {region: futures[region].result() for region in futures}
+
+
+def checkPlan(client_map, client_pool, plan, max_workers):
+    # One batched describe of AMIs and one of snapshots per region, and one
+    # listing per S3 directory; anything that no longer looks the way it was
+    # planned is left alone
+    region_amis = {}
+    for entry in plan["images"]:
+        region_amis.setdefault(entry["region"], []).append(entry["ami_id"])
+    region_snaps = {}
+    for entry in plan["snapshots"]:
+        region_snaps.setdefault(entry["region"], []).append(entry["snapshot_id"])
+    images = describeRegions(client_map, region_amis, max_workers)
+    snapshots = describeSnapshotRegions(client_map, region_snaps, max_workers)
+    # A planned snapshot that's gone is fine; one in another state means the
+    # AMI using it has moved on
+    changed = {}
+    for entry in plan["snapshots"]:
+        snapshot = snapshots[entry["region"]].get(entry["snapshot_id"])
+        if snapshot is not None and snapshot["State"] != entry["state"]:
+            changed.update({entry["snapshot_id"]: snapshot["State"]})
+    fresh_amis = {}
+    planned = {}
+    stale = 0
+    for entry in plan["images"]:
+        region = entry["region"]
+        image = images[region].get(entry["ami_id"])
+        if image is not None and (image["State"] != entry["state"] or imageSnapshots(image) != entry["snapshot"]):
+            print("{} in region {} has changed since the plan was made; not touching it or its snapshots".format(entry["ami_id"], region))
+            logEvent(entry["ami_id"], region, "deregister_image", "stale", state=image["State"], planned_state=entry["state"])
+            stale += 1
+            continue
+        moved = [snap for snap in entry["snapshot"] if snap in changed]
+        if len(moved) > 0:
+            for snap in moved:
+                print("{} in region {} is {} since the plan was made; not touching {} or its snapshots".format(snap, region, changed[snap], entry["ami_id"]))
+                logEvent(snap, region, "delete_snapshot", "stale", state=changed[snap], image=entry["ami_id"])
+            stale += 1
+            continue
+        fresh_amis.setdefault(region, []).append(entry["ami_id"])
+        planned.update({entry["ami_id"]: entry["snapshot"]})
+    found = statS3Files(client_pool, [entry["uri"] for entry in plan["s3_objects"]])
+    s3_filename_list = []
+    for entry in plan["s3_objects"]:
+        if entry["uri"] not in found:
+            print("{} is already gone, ok".format(entry["uri"]))
+            logEvent(entry["uri"], entry["region"], "delete_object", "gone")
+        elif found[entry["uri"]]["etag"] != entry["etag"]:
+            print("{} has changed since the plan was made; not deleting it".format(entry["uri"]))
+            logEvent(entry["uri"], entry["region"], "delete_object", "stale", etag=found[entry["uri"]]["etag"], planned_etag=entry["etag"])
+            stale += 1
+        else:
+            s3_filename_list.append(entry["uri"])
+    return fresh_amis, images, planned, s3_filename_list, stale
+
+
 def main():
 
-    # Reorient stdout to a string so we can capture it
-    tmp_stdout = sys.stdout
-    string_stdout = StringIO()
-    sys.stdout = string_stdout
+    # Stream stdout to the console and the log file as it's printed
+    log_filename = env_set("INPUT_LOG_FILENAME", "reaper.log")
+    metrics_filename = env_set("INPUT_METRICS_FILENAME", "") or "{}.metrics.json".format(os.path.splitext(log_filename)[0])
+    metrics = Metrics()
+    startLog(log_filename, env_set("INPUT_EVENTS_FILENAME", ""))
 
     # Prime the stdout pump - we seem to lose the first line otherwise
     print()
 
-    os.environ["AWS_ACCESS_KEY_ID"] = env_set("INPUT_AWS_ACCESS_KEY_ID", "")
-    os.environ["AWS_SECRET_ACCESS_KEY"] = env_set("INPUT_AWS_SECRET_ACCESS_KEY", "")
-    os.environ["AWS_DEFAULT_REGION"] = env_set("INPUT_AWS_REGION", "us-east-2")
+    session = newSession(
+        env_set("INPUT_AWS_ACCESS_KEY_ID", ""),
+        env_set("INPUT_AWS_SECRET_ACCESS_KEY", ""),
+        env_set("INPUT_AWS_REGION", "us-east-2"),
+    )
+    client_pool = newClientPool(session, metrics)
 
     snapshot_path = env_set("INPUT_SNAPSHOT_PATH", "")
     snapshot_date = env_set("INPUT_SNAPSHOT_DATE", "")
-    log_filename = env_set("INPUT_LOG_FILENAME", "reaper.log")
     resources_filename = env_set("INPUT_RESOURCES_FILENAME", "resources.json")
-    dry_run_string = env_set("INPUT_DRY_RUN", "false")
+    dry_run = envFlag("INPUT_DRY_RUN", "false")
+    max_workers = max(1, int(env_set("INPUT_MAX_WORKERS", "8")))
+    snapshots_root = env_set("INPUT_SNAPSHOTS_ROOT", "")
+    retention_keep = env_set("INPUT_RETENTION_KEEP", "")
+    retention_older_than = env_set("INPUT_RETENTION_OLDER_THAN", "")
+    purge_versions = envFlag("INPUT_PURGE_VERSIONS", "false")
+    inventory_cache = env_set("INPUT_INVENTORY_CACHE", "")
+    inventory_ttl = int(env_set("INPUT_INVENTORY_TTL", "900"))
+    verify_timeout = int(env_set("INPUT_VERIFY_TIMEOUT", "300"))
+    journal_filename = env_set("INPUT_JOURNAL_FILENAME", "") or "{}.journal.jsonl".format(os.path.splitext(resources_filename)[0])
+    mode = env_set("INPUT_MODE", "").strip().lower()
+    plan_filename = env_set("INPUT_PLAN_FILENAME", "") or "{}.plan.json".format(os.path.splitext(resources_filename)[0])
 
-    if dry_run_string == "false" or dry_run_string == "False":
-        dry_run = False
-    else:
-        dry_run = True
-
-    print("Reaper dry run request: {}".format(dry_run))
-    aws_account_id = whoami()
-    ami_map = findAMIs(snapshot_path, snapshot_date)
-    ec2_client_map = loginEC2Clients(ami_map)
-    # print("Client map: \n{}".format(json.dumps(ec2_client_map, indent=4)))
-    snap_map = findSNAPs(ec2_client_map, ami_map)
-    s3_filename_list = findS3Filenames(ec2_client_map, snapshot_path, snapshot_date)
+    print("Reaper dry run request: {}, mode: {}".format(dry_run, mode or "reap"))
+    aws_account_id = whoami(client_pool)
     print("AWS account ID:\n{}".format(json.dumps(aws_account_id, indent=4)))
-    print("AMI map:\n{}".format(json.dumps(ami_map, indent=4)))
-    print("SNAP map:\n{}".format(json.dumps(snap_map, indent=4)))
-    print("S3 filename list:\n{}".format(json.dumps(s3_filename_list, indent=4)))
-    success = False
-    success = deleteAMIs(ec2_client_map, ami_map, dry_run)
-    if success:
-        success = deleteSNAPs(ec2_client_map, snap_map, dry_run)
+    inventory = None
+    if inventory_cache != "":
+        inventory = Inventory(inventory_cache, aws_account_id, inventory_ttl)
+    # Everything finished is journaled as it happens; a re-run after a
+    # failure picks up where this one stopped.  Dry runs and plans finish
+    # nothing, so they only read it.
+    journal = Journal(journal_filename, read_only=dry_run or mode == "plan")
+    success = True
+    snapshots = []
+    snapshot_map = {}
+    region_amis = {}
+    plan = None
+    if mode not in ["", "plan", "apply"]:
+        print("mode must be plan or apply, not {}; not reaping anything".format(mode))
+        success = False
+    elif mode == "apply":
+        # The plan already holds everything discovery would find
+        plan = loadPlan(plan_filename, aws_account_id)
+        if plan is None:
+            success = False
+        else:
+            snapshots_root = plan["snapshots_root"]
+            snapshot_date = plan["snapshot_date"]
+            snapshot_map = plan["snapshot_map"]
+            for entry in plan["images"]:
+                region_amis.setdefault(entry["region"], []).append(entry["ami_id"])
+    elif snapshots_root != "":
+        if retention_keep == "" and retention_older_than == "":
+            print("Sweeping {} needs retention_keep and/or retention_older_than; not reaping anything".format(snapshots_root))
+            success = False
+        else:
+            snapshots = findExpiredSnapshots(snapshots_root, retention_keep, retention_older_than)
+    else:
+        snapshots = [(snapshot_path, snapshot_date)]
+
+    # Gather every snapshot's resources up front so each region gets one
+    # batched describe and one reap chain no matter how many snapshots it holds
+    listings = {}
+    for path, date in snapshots:
+        print("Snapshot {}:".format(path))
+        index = loadSnapshotIndex(path, date)
+        ami_map = findAMIs(index)
+        s3_filename_list = findS3Filenames(client_pool, ami_map, index, listings)
+        print("AMI map:\n{}".format(json.dumps(ami_map, indent=4)))
+        print("S3 filename list:\n{}".format(json.dumps(s3_filename_list, indent=4)))
+        snapshot_map.update({date: {"ami_map": ami_map, "s3_files": s3_filename_list}})
+        for region in ami_map:
+            region_amis.setdefault(region, []).append(ami_map[region])
+    # Clients are only created for regions that turn out to have something to reap
+    ec2_client_map = loginEC2Clients(client_pool, region_amis, inventory)
+    snaps = {}
+    stale = 0
+    protected = set()
+    deployed_ok = True
+    if success and mode != "apply" and snapshots_root != "":
+        deployed_ok, region_amis, protected = dropDeployed(ec2_client_map, region_amis, max_workers)
+    if success and mode == "plan":
+        try:
+            plan = {
+                "version": PLAN_VERSION,
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "account_id": aws_account_id,
+                "snapshots_root": snapshots_root,
+                "snapshot_date": snapshot_date,
+                "snapshot_map": snapshot_map,
+                # The deployed AMIs never make it into the plan's images, so
+                # apply needs them to know which dates to leave unreaped
+                "protected": sorted(protected),
+            }
+            s3_filename_list = reapableS3Files(snapshot_map, protected)
+            plan.update(makePlan(ec2_client_map, client_pool, region_amis, s3_filename_list, max_workers, inventory, journal))
+            savePlan(plan_filename, plan)
+            snaps = {entry["ami_id"]: entry["snapshot"] for entry in plan["images"] if len(entry["snapshot"]) > 0}
+        except botocore.exceptions.ClientError as err1:
+            print("Try of planning error: {}\n{}".format(json.dumps(err1.response, indent=4, sort_keys=True, default=str), err1))
+            success = False
+    elif success:
+        images = None
+        planned = None
+        s3_filename_list = reapableS3Files(snapshot_map, protected)
+        if plan is not None:
+            try:
+                region_amis, images, planned, s3_filename_list, stale = checkPlan(ec2_client_map, client_pool, plan, max_workers)
+                if snapshots_root != "":
+                    # Kept when the plan was made, or tagged deployed since
+                    deployed_ok, region_amis, protected = dropDeployed(ec2_client_map, region_amis, max_workers)
+                    protected.update(plan["protected"])
+                    reapable = set(reapableS3Files(snapshot_map, protected))
+                    s3_filename_list = [s3_file for s3_file in s3_filename_list if s3_file in reapable]
+            except botocore.exceptions.ClientError as err1:
+                print("Try of checking the plan error: {}\n{}".format(json.dumps(err1.response, indent=4, sort_keys=True, default=str), err1))
+                success = False
         if success:
-            success = deleteS3Files(s3_filename_list, dry_run)
-    # Reorient stdout back to normal, write it to the log file, and dump out what it was
-    sys.stdout = tmp_stdout
-    with open(log_filename, "w") as out_file:
-        out_file.write(string_stdout.getvalue())
-        out_file.close()
-    print(string_stdout.getvalue())
-    resources = {"account_id": aws_account_id, "ami_map": ami_map, "snap_map": snap_map, "s3_files": s3_filename_list}
+            # Deletions are confirmed together afterwards rather than one by one
+            pending = None if dry_run or verify_timeout <= 0 else PendingDeletions()
+            success, snaps = reapRegions(ec2_client_map, region_amis, dry_run, max_workers, inventory, pending, journal, images, planned)
+            if pending is not None and not verifyDeletions(ec2_client_map, pending, verify_timeout, journal=journal):
+                success = False
+            if success:
+                success = deleteS3Files(client_pool, s3_filename_list, dry_run, purge_versions, journal)
+    for date in snapshot_map:
+        ami_map = snapshot_map[date]["ami_map"]
+        snap_map = {region: snaps[ami_map[region]] for region in ami_map if ami_map[region] in snaps}
+        snapshot_map[date].update({"snap_map": snap_map})
+        print("SNAP map for {}:\n{}".format(date, json.dumps(snap_map, indent=4)))
+    if stale > 0:
+        print("{} planned resources changed since the plan was made and were left alone; make a new plan".format(stale))
+        success = False
+    if not deployed_ok:
+        success = False
+    if success and not dry_run and mode != "plan" and snapshots_root != "":
+        markReaped(snapshots_root, reapableDates(snapshot_map, protected), aws_account_id)
+    journal.close()
+    metrics.report(metrics_filename, "reapsnapshot")
+    stopLog()
+    if snapshots_root != "":
+        resources = {"account_id": aws_account_id, "snapshots": {"SNAPSHOT-{}".format(date): snapshot_map[date] for date in snapshot_map}}
+    else:
+        resources = {"account_id": aws_account_id, "ami_map": {}, "snap_map": {}, "s3_files": []}
+        resources.update(snapshot_map.get(snapshot_date, {}))
     with open(resources_filename, "w") as out_file:
         out_file.write(json.dumps(resources, indent=4))
         out_file.close()
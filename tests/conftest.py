@@ -0,0 +1,38 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+from moto import mock_aws
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadAction(action):
+    # Each action imports amimgmt from its own directory, as in its Docker image
+    sys.path.insert(0, os.path.join(ROOT, action))
+    spec = importlib.util.spec_from_file_location("{}_main".format(action), os.path.join(ROOT, action, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    # Fake credentials, so nothing can reach a real account
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-2")
+    with mock_aws():
+        yield
+
+
+def registerAMI(client, name):
+    volume = client.create_volume(AvailabilityZone="{}a".format(client.meta.region_name), Size=8)
+    snapshot = client.create_snapshot(VolumeId=volume["VolumeId"])
+    response = client.register_image(
+        Name=name,
+        RootDeviceName="/dev/sda1",
+        BlockDeviceMappings=[{"DeviceName": "/dev/sda1", "Ebs": {"SnapshotId": snapshot["SnapshotId"]}}],
+    )
+    return response["ImageId"]
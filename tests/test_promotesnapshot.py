@@ -0,0 +1,27 @@
+import boto3
+import botocore.exceptions
+
+from conftest import loadAction, registerAMI
+
+promotesnapshot = loadAction("promotesnapshot")
+
+
+def testVanishedCopyFails(aws):
+    client = boto3.client("ec2", region_name="eu-west-1")
+    job = {"ami_id": "ami-0123456789abcdef0", "name": "aoc-test", "source_region": "us-east-2", "region": "eu-west-1", "copy_id": "ami-0fedcba987654321f"}
+    success, replicated = promotesnapshot.replicateAMIs({"eu-west-1": client}, [job], "deployed", 1, 30, first_delay=0.01, max_delay=0.01)
+    assert not success
+    assert replicated == {}
+
+
+def testFindReplicasSkipsRegionsItCantSee(aws):
+    clients = {region: boto3.client("ec2", region_name=region) for region in ["eu-west-1", "ca-central-1"]}
+    copy_id = registerAMI(clients["eu-west-1"], "aoc-test")
+
+    def notOptedIn(**kwargs):
+        raise botocore.exceptions.ClientError({"Error": {"Code": "OptInRequired", "Message": "not subscribed"}}, "DescribeImages")
+
+    clients["ca-central-1"].meta.events.register("before-call.ec2.DescribeImages", notOptedIn)
+    replicas, failed = promotesnapshot.findReplicas(clients, ["eu-west-1", "ca-central-1"], "aoc-test")
+    assert replicas["eu-west-1"]["ImageId"] == copy_id
+    assert failed == ["ca-central-1"]
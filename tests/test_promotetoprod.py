@@ -0,0 +1,45 @@
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+from conftest import loadAction
+
+promotetoprod = loadAction("promotetoprod")
+
+KEY = "functions/controller-2022-01-01-00-00-00.zip"
+
+
+@pytest.fixture
+def s3(aws):
+    client = boto3.client("s3", region_name="us-east-2")
+    for bucket in ["dev-bkt", "prod-bkt"]:
+        client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "us-east-2"})
+    client.put_object(Bucket="dev-bkt", Key=KEY, Body=b"controller" * 100)
+    return client
+
+
+def copy(client, source, readable):
+    return promotetoprod.copyS3Object(client, client, "dev-bkt", KEY, "prod-bkt", source, TransferConfig(), {"dev-bkt": readable})
+
+
+@pytest.mark.parametrize("readable", [True, False])
+def testCopyChecksSinglePartMD5(s3, readable):
+    entry = copy(s3, s3.head_object(Bucket="dev-bkt", Key=KEY), readable)
+    assert entry["verified"] == "md5"
+
+
+@pytest.mark.parametrize("readable", [True, False])
+def testCopyFailsOnMD5Mismatch(s3, readable):
+    source = s3.head_object(Bucket="dev-bkt", Key=KEY)
+    source.update({"ETag": '"{}"'.format("0" * 32)})
+    with pytest.raises(promotetoprod.IntegrityError):
+        copy(s3, source, readable)
+    assert "Contents" not in s3.list_objects_v2(Bucket="prod-bkt")
+
+
+def testStreamedMultipartETagIsUnverified(s3):
+    source = s3.head_object(Bucket="dev-bkt", Key=KEY)
+    source.update({"ETag": '"{}-2"'.format("0" * 32)})
+    entry = copy(s3, source, False)
+    assert entry["verified"] == "unverified"
+    assert entry["sha256"] == s3.head_object(Bucket="prod-bkt", Key=KEY, ChecksumMode="ENABLED")["ChecksumSHA256"]
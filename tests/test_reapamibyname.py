@@ -0,0 +1,108 @@
+import boto3
+import botocore.exceptions
+
+from conftest import loadAction, registerAMI
+
+reapamibyname = loadAction("reapamibyname")
+
+FAMILY = r"nightly-(\w+)-"
+
+
+class CachedImages:
+    # Stands in for Inventory, serving whatever image records it was given
+    def __init__(self, images):
+        self._images = images
+
+    def images(self, client, region):
+        return self._images
+
+
+def imageRecords(client, names, tags=()):
+    # Each image a day newer than the one before, so retention has an order to go by
+    records = {}
+    ids = {}
+    for day, name in enumerate(names, 1):
+        ami_id = registerAMI(client, name)
+        image = client.describe_images(ImageIds=[ami_id])["Images"][0]
+        image.update({"CreationDate": "2022-01-{:02d}T00:00:00.000Z".format(day)})
+        if name in tags:
+            image.update({"Tags": [{"Key": reapamibyname.PROMOTION_TAG, "Value": "deployed"}]})
+        records.update({ami_id: image})
+        ids.update({name: ami_id})
+    return records, ids
+
+
+def testKeepsNewestPerFamily(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    records, ids = imageRecords(client, ["nightly-a-1", "nightly-b-1", "nightly-a-2", "nightly-a-3", "nightly-b-2", "nightly-a-4", "other-1"])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "2", "", CachedImages(records))
+    assert sorted(expired) == sorted([ids["nightly-a-1"], ids["nightly-a-2"]])
+    assert kept == {"a": sorted([ids["nightly-a-3"], ids["nightly-a-4"]]), "b": sorted([ids["nightly-b-1"], ids["nightly-b-2"]])}
+    assert protected == []
+    assert expired[ids["nightly-a-1"]] == [bdm["Ebs"]["SnapshotId"] for bdm in records[ids["nightly-a-1"]]["BlockDeviceMappings"]]
+
+
+def testOlderThanNarrowsKeep(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    records, ids = imageRecords(client, ["nightly-a-1", "nightly-a-2", "nightly-a-3", "nightly-a-4"])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "1", "2022-01-02", CachedImages(records))
+    assert sorted(expired) == [ids["nightly-a-1"]]
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "", "2022-01-03", CachedImages(records))
+    assert sorted(expired) == sorted([ids["nightly-a-1"], ids["nightly-a-2"]])
+    assert kept == {}
+
+
+def testDeployedNeverExpires(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    records, ids = imageRecords(client, ["nightly-a-1", "nightly-a-2", "nightly-a-3"], tags=["nightly-a-1"])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "1", "", CachedImages(records))
+    assert sorted(expired) == [ids["nightly-a-2"]]
+    assert protected == [ids["nightly-a-1"]]
+
+
+def testDeployedSinceCachedIsCheckedLive(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    records, ids = imageRecords(client, ["nightly-a-1", "nightly-a-2", "nightly-a-3"])
+    # Tagged after the cached records were taken
+    client.create_tags(Resources=[ids["nightly-a-1"]], Tags=[{"Key": reapamibyname.PROMOTION_TAG, "Value": "deployed"}])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "1", "", CachedImages(records))
+    assert sorted(expired) == [ids["nightly-a-2"]]
+    assert protected == [ids["nightly-a-1"]]
+
+
+def testReadsLiveImagesWithoutInventory(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    ids = {name: registerAMI(client, name) for name in ["nightly-a-1", "nightly-a-2", "other-1"]}
+    client.create_tags(Resources=[ids["nightly-a-2"]], Tags=[{"Key": reapamibyname.PROMOTION_TAG, "Value": "deployed"}])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "", "9999", None)
+    assert sorted(expired) == [ids["nightly-a-1"]]
+    assert protected == [ids["nightly-a-2"]]
+
+
+def testBlankVolumesHaveNoSnapshot(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    records, ids = imageRecords(client, ["nightly-a-1", "nightly-a-2"])
+    image = records[ids["nightly-a-1"]]
+    snaps = [bdm["Ebs"]["SnapshotId"] for bdm in image["BlockDeviceMappings"]]
+    image["BlockDeviceMappings"].extend([{"DeviceName": "/dev/sdb", "Ebs": {"VolumeSize": 100}}, {"DeviceName": "/dev/sdc", "VirtualName": "ephemeral0"}])
+    expired, kept, protected = reapamibyname.findExpiredAMIs(client, "us-east-2", FAMILY, "1", "", CachedImages(records))
+    assert expired == {ids["nightly-a-1"]: snaps}
+
+
+def testOrphansOnlyReportedWithoutIncludeDisabled(aws):
+    client = boto3.client("ec2", region_name="us-east-2")
+    volume = client.create_volume(AvailabilityZone="us-east-2a", Size=8)
+    orphan = client.create_snapshot(VolumeId=volume["VolumeId"], Description="Created for orphan-test")["SnapshotId"]
+
+    def oldBotocore(params, **kwargs):
+        # What a botocore from before IncludeDisabled does with it
+        if "IncludeDisabled" in params:
+            raise botocore.exceptions.ParamValidationError(report="Unknown parameter in input: IncludeDisabled")
+
+    client.meta.events.register("provide-client-params.ec2.DescribeImages", oldBotocore)
+    scanned, referenced, orphans, complete = reapamibyname.findOrphans(client, "us-east-2", 0, "orphan-test")
+    assert [snap for snap, start_date, description in orphans] == [orphan]
+    assert not complete
+    success, orphan_map = reapamibyname.scanOrphans({"us-east-2": client}, 1, 0, "orphan-test")
+    assert success
+    assert orphan_map == {}
@@ -0,0 +1,257 @@
+import copy
+import json
+import os
+
+import boto3
+import botocore.exceptions
+import pytest
+
+from conftest import loadAction, registerAMI
+
+reapsnapshot = loadAction("reapsnapshot")
+
+DATES = ["2022-01-01-00-00-00", "2022-02-01-00-00-00", "2022-03-01-00-00-00", "2022-04-01-00-00-00", "2022-05-01-00-00-00"]
+
+
+def makeSnapshots(root, dates):
+    for dirname in ["SNAPSHOT-{}".format(date) for date in dates] + ["SNAPSHOT-2021-08", "SNAPSHOT-", "other"]:
+        os.makedirs(os.path.join(root, dirname))
+
+
+def expiredDates(snapshots):
+    return [date for path, date in snapshots]
+
+
+def testSweepKeepsNewest(tmp_path):
+    makeSnapshots(str(tmp_path), DATES)
+    snapshots = reapsnapshot.findExpiredSnapshots(str(tmp_path), "2", "")
+    assert expiredDates(snapshots) == DATES[:3]
+    assert snapshots[0][0] == "{}/SNAPSHOT-{}".format(tmp_path, DATES[0])
+
+
+def testSweepOlderThan(tmp_path):
+    makeSnapshots(str(tmp_path), DATES)
+    assert expiredDates(reapsnapshot.findExpiredSnapshots(str(tmp_path), "", "2022-03-01")) == DATES[:2]
+
+
+def testSweepNeedsBothRules(tmp_path):
+    makeSnapshots(str(tmp_path), DATES)
+    assert expiredDates(reapsnapshot.findExpiredSnapshots(str(tmp_path), "2", "2022-02-15")) == DATES[:2]
+    assert expiredDates(reapsnapshot.findExpiredSnapshots(str(tmp_path), "4", "2022-04-15")) == DATES[:1]
+    assert expiredDates(reapsnapshot.findExpiredSnapshots(str(tmp_path), "9", "")) == []
+
+
+def testSweepSkipsReaped(tmp_path):
+    makeSnapshots(str(tmp_path), DATES)
+    reapsnapshot.markReaped(str(tmp_path), DATES[:2], "123456789012")
+    # Reaped snapshots still count towards the ones kept
+    assert expiredDates(reapsnapshot.findExpiredSnapshots(str(tmp_path), "2", "")) == DATES[2:3]
+
+
+def testJournalResumesPastTruncatedLine(tmp_path):
+    filename = str(tmp_path / "resources.journal.jsonl")
+    journal = reapsnapshot.Journal(filename)
+    journal.record("ami-1", "us-east-2", "deregister_image", "deleted", snapshot=["snap-1", "snap-2"])
+    journal.record("snap-1", "us-east-2", "delete_snapshot", "deleted", image="ami-1")
+    journal.close()
+    # The run died halfway through writing its next record
+    with open(filename, "a") as out_file:
+        out_file.write('{"resource": "snap-2", "operation": "delete_snap')
+    journal = reapsnapshot.Journal(filename)
+    assert reapsnapshot.journaledSNAPs(journal.finished("ami-1", "deregister_image")) == ["snap-1", "snap-2"]
+    assert journal.finished("snap-1", "delete_snapshot") is not None
+    assert journal.finished("snap-2", "delete_snapshot") is None
+    journal.record("snap-2", "us-east-2", "delete_snapshot", "deleted", image="ami-1")
+    journal.close()
+    # The new record starts a line of its own, so the next run reads it
+    journal = reapsnapshot.Journal(filename)
+    assert journal.finished("snap-2", "delete_snapshot")["outcome"] == "deleted"
+    journal.close()
+
+
+def testJournalReadsSingleSnapshotRecords():
+    assert reapsnapshot.journaledSNAPs({"snapshot": "snap-1"}) == ["snap-1"]
+    assert reapsnapshot.journaledSNAPs({"snapshot": None}) == []
+
+
+REGIONS = ["us-east-1", "us-east-2"]
+DATE = DATES[0]
+
+
+def putArtifacts(region, date):
+    bucket = "positronic-asimov-{}".format(region)
+    s3_client = boto3.client("s3", region_name=region)
+    try:
+        if region == "us-east-1":
+            s3_client.create_bucket(Bucket=bucket)
+        else:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": region})
+    except botocore.exceptions.ClientError as err1:
+        if err1.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+            raise
+    s3_files = []
+    for key in ["functions/controller-{}.zip".format(date), "cdk/template-production-{}.json".format(date)]:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=b"artifact")
+        s3_files.append("s3://{}/{}".format(bucket, key))
+    return s3_files
+
+
+def makeSnapshotDir(root, date):
+    # An aoc-artifacts snapshot: one AMI and two S3 artifacts per region
+    path = os.path.join(root, "SNAPSHOT-{}".format(date))
+    os.makedirs(path)
+    ami_map = {}
+    s3_files = []
+    for region in REGIONS:
+        ami_map.update({region: registerAMI(boto3.client("ec2", region_name=region), "aoc-{}".format(date))})
+        s3_files.extend(putArtifacts(region, date))
+    with open(os.path.join(path, "aws-ami-regions_SNAPSHOT-{}.json".format(date)), "w") as out_file:
+        json.dump(ami_map, out_file)
+    with open(os.path.join(path, "s3_file_locations.txt"), "w") as out_file:
+        out_file.write("\n".join(s3_files) + "\n")
+    return ami_map, s3_files
+
+
+def tagDeployed(region, ami_id):
+    boto3.client("ec2", region_name=region).create_tags(Resources=[ami_id], Tags=[{"Key": reapsnapshot.PROMOTION_TAG, "Value": "deployed"}])
+
+
+def runReap(monkeypatch, workdir, **inputs):
+    monkeypatch.chdir(workdir)
+    monkeypatch.setenv("INPUT_VERIFY_TIMEOUT", "5")
+    for name in inputs:
+        monkeypatch.setenv("INPUT_{}".format(name.upper()), inputs[name])
+    with pytest.raises(SystemExit) as exited:
+        reapsnapshot.main()
+    return exited.value.code
+
+
+def existingImages(region):
+    return [image["ImageId"] for image in boto3.client("ec2", region_name=region).describe_images(Owners=["self"])["Images"]]
+
+
+def existingS3Files(s3_files):
+    existing = []
+    for s3_file in s3_files:
+        bucket, key = reapsnapshot.splitS3URI(s3_file)
+        s3_client = boto3.client("s3", region_name=reapsnapshot.bucketRegion(bucket))
+        if s3_client.list_objects_v2(Bucket=bucket, Prefix=key).get("KeyCount", 0) > 0:
+            existing.append(s3_file)
+    return existing
+
+
+def isReaped(root, date):
+    return os.path.exists(os.path.join(root, "SNAPSHOT-{}".format(date), reapsnapshot.REAPED_MARKER))
+
+
+def testSweepKeepsDeployedSnapshot(aws, monkeypatch, tmp_path):
+    root = str(tmp_path / "snapshots")
+    kept_amis, kept_files = makeSnapshotDir(root, DATES[0])
+    reaped_amis, reaped_files = makeSnapshotDir(root, DATES[1])
+    tagDeployed("us-east-2", kept_amis["us-east-2"])
+    assert not runReap(monkeypatch, str(tmp_path), snapshots_root=root, retention_keep="0")
+    assert existingImages("us-east-2") == [kept_amis["us-east-2"]]
+    # The whole deployed snapshot's artifacts stay, in every region
+    assert existingS3Files(kept_files) == kept_files
+    assert existingS3Files(reaped_files) == []
+    assert not isReaped(root, DATES[0])
+    assert isReaped(root, DATES[1])
+
+
+def testApplyKeepsPlannedDeployedSnapshot(aws, monkeypatch, tmp_path):
+    root = str(tmp_path / "snapshots")
+    kept_amis, kept_files = makeSnapshotDir(root, DATES[0])
+    reaped_amis, reaped_files = makeSnapshotDir(root, DATES[1])
+    tagDeployed("us-east-2", kept_amis["us-east-2"])
+    assert not runReap(monkeypatch, str(tmp_path), snapshots_root=root, retention_keep="0", mode="plan")
+    assert not runReap(monkeypatch, str(tmp_path), mode="apply")
+    assert existingImages("us-east-2") == [kept_amis["us-east-2"]]
+    assert existingS3Files(kept_files) == kept_files
+    assert existingS3Files(reaped_files) == []
+    assert not isReaped(root, DATES[0])
+    assert isReaped(root, DATES[1])
+
+
+@pytest.fixture
+def planned(aws):
+    # One AMI and two artifacts per region, planned the way mode plan does
+    session = reapsnapshot.newSession(region="us-east-2")
+    client_pool = reapsnapshot.newClientPool(session)
+    client_map = reapsnapshot.loginEC2Clients(client_pool, REGIONS)
+    region_amis = {}
+    s3_files = []
+    for region in REGIONS:
+        region_amis.update({region: [registerAMI(client_map[region], "aoc-{}".format(DATE))]})
+        s3_files.extend(putArtifacts(region, DATE))
+    plan = reapsnapshot.makePlan(client_map, client_pool, region_amis, s3_files, 2)
+    return client_map, client_pool, plan
+
+
+def testFreshPlan(planned):
+    client_map, client_pool, plan = planned
+    fresh_amis, images, snaps, s3_filename_list, stale = reapsnapshot.checkPlan(client_map, client_pool, plan, 2)
+    assert stale == 0
+    assert fresh_amis == {entry["region"]: [entry["ami_id"]] for entry in plan["images"]}
+    assert snaps == {entry["ami_id"]: entry["snapshot"] for entry in plan["images"]}
+    assert sorted(s3_filename_list) == sorted(entry["uri"] for entry in plan["s3_objects"])
+
+
+def testGoneResourcesAreNotStale(planned):
+    client_map, client_pool, plan = planned
+    image = plan["images"][0]
+    client_map[image["region"]].deregister_image(ImageId=image["ami_id"])
+    gone = plan["s3_objects"][0]["uri"]
+    bucket, key = reapsnapshot.splitS3URI(gone)
+    boto3.client("s3", region_name="us-east-1").delete_object(Bucket=bucket, Key=key)
+    fresh_amis, images, snaps, s3_filename_list, stale = reapsnapshot.checkPlan(client_map, client_pool, plan, 2)
+    assert stale == 0
+    # The planned snapshots of a gone AMI are still reaped
+    assert image["ami_id"] in fresh_amis[image["region"]]
+    assert snaps[image["ami_id"]] == image["snapshot"]
+    assert gone not in s3_filename_list
+
+
+def testChangedS3ObjectIsStale(planned):
+    client_map, client_pool, plan = planned
+    changed = plan["s3_objects"][-1]["uri"]
+    bucket, key = reapsnapshot.splitS3URI(changed)
+    boto3.client("s3", region_name="us-east-2").put_object(Bucket=bucket, Key=key, Body=b"rebuilt")
+    fresh_amis, images, snaps, s3_filename_list, stale = reapsnapshot.checkPlan(client_map, client_pool, plan, 2)
+    assert stale == 1
+    assert changed not in s3_filename_list
+    assert len(s3_filename_list) == len(plan["s3_objects"]) - 1
+
+
+def testChangedImageIsStale(planned):
+    client_map, client_pool, plan = planned
+    plan = copy.deepcopy(plan)
+    image = plan["images"][0]
+    image.update({"snapshot": image["snapshot"] + ["snap-0123456789abcdef0"]})
+    fresh_amis, images, snaps, s3_filename_list, stale = reapsnapshot.checkPlan(client_map, client_pool, plan, 2)
+    assert stale == 1
+    assert image["region"] not in fresh_amis
+    assert image["ami_id"] not in snaps
+
+
+def testChangedSnapshotIsStale(planned):
+    client_map, client_pool, plan = planned
+    plan = copy.deepcopy(plan)
+    snapshot = plan["snapshots"][-1]
+    snapshot.update({"state": "pending"})
+    fresh_amis, images, snaps, s3_filename_list, stale = reapsnapshot.checkPlan(client_map, client_pool, plan, 2)
+    assert stale == 1
+    assert snapshot["image"] not in snaps
+    assert snapshot["region"] not in fresh_amis
+    assert len(snaps) == len(plan["images"]) - 1
+
+
+def testDryRunLeavesNoJournal(aws, monkeypatch, tmp_path):
+    root = str(tmp_path / "snapshots")
+    ami_map, s3_files = makeSnapshotDir(root, DATE)
+    path = os.path.join(root, "SNAPSHOT-{}".format(DATE))
+    assert not runReap(monkeypatch, str(tmp_path), snapshot_path=path, snapshot_date=DATE, dry_run="true")
+    assert not os.path.exists(str(tmp_path / "resources.journal.jsonl"))
+    assert existingS3Files(s3_files) == s3_files
+    assert not runReap(monkeypatch, str(tmp_path), snapshot_path=path, snapshot_date=DATE, dry_run="false")
+    assert existingS3Files(s3_files) == []
+    assert all(ami_map[region] not in existingImages(region) for region in REGIONS)
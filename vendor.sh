@@ -0,0 +1,31 @@
+#!/bin/sh
+# Each action's Docker image is built from the action's own directory, so the
+# shared amimgmt package is copied into every action that uses it.  Run this
+# after editing amimgmt/; CI runs it with --check to catch stale copies.
+set -e
+cd "$(dirname "$0")"
+
+ACTIONS="promotegcptoprod promotesnapshot promotetoprod reapamibyname reapsnapshot"
+
+status=0
+for action in $ACTIONS; do
+    if [ "$1" = "--check" ]; then
+        for file in amimgmt/*.py; do
+            if ! cmp -s "$file" "$action/$file"; then
+                echo "$action/$file is out of date; run ./vendor.sh"
+                status=1
+            fi
+        done
+        for file in "$action"/amimgmt/*.py; do
+            if [ ! -f "amimgmt/$(basename "$file")" ]; then
+                echo "$file has no counterpart in amimgmt/; run ./vendor.sh"
+                status=1
+            fi
+        done
+    else
+        rm -rf "$action/amimgmt"
+        mkdir "$action/amimgmt"
+        cp amimgmt/*.py "$action/amimgmt/"
+    fi
+done
+exit $status